@@ -1,22 +1,31 @@
-import os
-import json
+import atexit
+import asyncio
+import hashlib
 import logging
-from dotenv import load_dotenv
-from openai import OpenAI
-from langsmith import traceable
+from common import MODEL_CLASSIFY, traceable, get_async_openai_client, get_embeddings, chat_completion, stream_chat_completion, json_schema_format, redact_inputs, json_loads, json_dumps, question_key, build_history_messages, render_history
 from sqlite_setup import get_sqlite_conn
 from text_to_sql import handle_user_question
-from text_to_query import handle_user_feedback_query
+from text_to_query import handle_user_feedback_query, get_feedback_snapshot
 from fetch_data_from_pdf import search_property_pdfs, generate_answer_from_context, faiss_index
+from llm_cache import SemanticLLMCache, ResponseCache
+from local_classifier import general_classifier
 
 # Setup logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Load keys
-load_dotenv()
-openai_api_key = os.getenv("OPENAI_API_KEY")
-client = OpenAI(api_key=openai_api_key)
+# Shared OpenAI client
+client = get_async_openai_client()
+
+# Semantic cache for LLM responses, persisted across restarts
+llm_cache = SemanticLLMCache(get_embeddings(), path="cache/llm")
+atexit.register(llm_cache.save)
+# Routes are only reused for the exact same question after the same previous turn
+route_cache = ResponseCache(path="cache/routes.pkl")
+atexit.register(route_cache.save)
+
+# Structured output for the general/business fallback classifier
+GENERAL_FORMAT = json_schema_format("message_type", {"is_general": {"type": "boolean"}})
 
 # Define the function schema for routing queries
 functions = [
@@ -45,7 +54,11 @@ functions = [
     }
 ]
 
-def is_general_message(user_message):
+async def is_general_message(user_message):
+    label = await asyncio.to_thread(general_classifier.classify, user_message)
+    if label is not None:
+        return label == "general"
+
     prompt = f"""
     You are a classification assistant.
 
@@ -53,20 +66,27 @@ def is_general_message(user_message):
 
     Message: "{user_message}"
 
-    Reply with one word only: "general" or "business"
+    Set is_general to true for general/small talk and false for a business question.
     """
-    try:
-        response = client.chat.completions.create(
-            model="gpt-4",
+    async def complete():
+        response = await chat_completion(
+            client,
+            model=MODEL_CLASSIFY,
             messages=[{"role": "user", "content": prompt}],
-            temperature=0
+            temperature=0,
+            max_tokens=16,
+            response_format=GENERAL_FORMAT
         )
-        return response.choices[0].message.content.strip().lower() == "general"
+        return response.choices[0].message.content
+
+    try:
+        content = await llm_cache.aget_or_compute(user_message, complete, namespace="is_general")
+        return json_loads(content)["is_general"]
     except Exception as e:
         logger.warning(f"Failed to classify message type: {e}")
         return False
 
-def generate_friendly_reply(user_message):
+async def generate_friendly_reply(user_message):
     prompt = f"""
     You are a friendly and professional assistant that helps business owners manage and analyze the performance of their real estate portfolio.
 
@@ -87,13 +107,18 @@ def generate_friendly_reply(user_message):
     Keep the tone helpful, business-focused, and brief.
     """
 
-    try:
-        response = client.chat.completions.create(
+    async def complete():
+        response = await chat_completion(
+            client,
             model="gpt-4",
             messages=[{"role": "user", "content": prompt}],
             temperature=0.5
         )
-        return response.choices[0].message.content.strip()
+        return response.choices[0].message.content
+
+    try:
+        content = await llm_cache.aget_or_compute(user_message, complete, namespace="friendly")
+        return content.strip()
     except Exception as e:
         logger.warning(f"Failed to generate friendly reply: {e}")
         return (
@@ -103,8 +128,8 @@ def generate_friendly_reply(user_message):
         )
 
 
-@traceable(name="route_query_with_function_call")
-def route_query_with_function_call(user_question, chat_memory_dict=None):
+@traceable(name="route_query_with_function_call", process_inputs=redact_inputs("history_messages"))
+async def route_query_with_function_call(user_question, history_messages=None):
     logger.info("Routing the query...")
     system_prompt = """
     You are a routing agent that determines the best backend (faiss, sql, firestore) to answer the user's question.
@@ -116,30 +141,36 @@ def route_query_with_function_call(user_question, chat_memory_dict=None):
     Use chat history to resolve vague references and infer property/agent mentions.
     """
 
-    messages = [{"role": "system", "content": system_prompt}]
-    if chat_memory_dict:
-        for i in range(1, len(chat_memory_dict) // 2 + 1):
-            messages.append({"role": "user", "content": chat_memory_dict[f"q{i}"]})
-            messages.append({"role": "assistant", "content": chat_memory_dict[f"a{i}"]})
+    messages = [{"role": "system", "content": system_prompt}, *(history_messages or [])]
     messages.append({"role": "user", "content": user_question})
 
-    try:
-        response = client.chat.completions.create(
-            model="gpt-4",
+    async def complete():
+        response = await chat_completion(
+            client,
+            model=MODEL_CLASSIFY,
             messages=messages,
             functions=functions,
             function_call={"name": "route_query"},
             temperature=0
         )
-        route_info = json.loads(response.choices[0].message.function_call.arguments)
+        return response.choices[0].message.function_call.arguments
+
+    # Exact key: one-word variants ("amenities" vs "feedback", "property 5" vs "property 6")
+    # embed alike but route differently, and the previous turn decides inferred mentions
+    last_turn = "\n".join(m["content"] for m in (history_messages or [])[-2:])
+    key = (question_key(user_question), hashlib.sha1(last_turn.encode()).hexdigest() if last_turn else "")
+
+    try:
+        arguments = await route_cache.aget_or_compute(key, complete)
+        route_info = json_loads(arguments)
         logger.info(f"Routing Decision: {route_info}")
         return route_info
     except Exception as e:
         logger.exception(f"Failed to route query: {e}")
         return {"destination": "sql", "property_mention": None, "agent_mention": None}
 
-@traceable(name="generate_natural_answer")
-def generate_natural_answer(user_question, structured_data):
+@traceable(name="generate_natural_answer", process_inputs=redact_inputs("structured_data"))
+async def generate_natural_answer(user_question, structured_data, stream=False):
     logger.info("Generating human-readable answer from structured data...")
 
     # Truncate to avoid token overflow
@@ -152,6 +183,8 @@ def generate_natural_answer(user_question, structured_data):
     except Exception as e:
         logger.warning(f"Data truncation failed: {e}")
 
+    # Compact JSON: indentation only adds prompt tokens
+    data_json = json_dumps(structured_data)
     prompt = f"""
     You are a helpful assistant. Summarize the result below in a user-friendly format.
     
@@ -164,34 +197,84 @@ def generate_natural_answer(user_question, structured_data):
     {user_question}
 
     Data:
-    {json.dumps(structured_data, indent=2)}
+    {data_json}
 
     Answer:
     """
 
+    request = {"model": "gpt-4", "messages": [{"role": "user", "content": prompt}], "temperature": 0.3}
+    # Only reuse an answer that was generated from the same data
+    metadata = {"data": hashlib.sha1(data_json.encode()).hexdigest()}
+
+    if stream:
+        async def stream_answer():
+            try:
+                async for delta in llm_cache.astream_or_compute(
+                    user_question,
+                    lambda: stream_chat_completion(client, **request),
+                    namespace="answer",
+                    metadata=metadata
+                ):
+                    yield delta
+            except Exception as e:
+                logger.exception(f"Failed to generate answer: {e}")
+                yield "There was an error while generating the final answer."
+        return stream_answer()
+
+    async def complete():
+        response = await chat_completion(client, **request)
+        return response.choices[0].message.content
+
     try:
-        response = client.chat.completions.create(
-            model="gpt-4",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.3
-        )
-        return response.choices[0].message.content.strip()
+        content = await llm_cache.aget_or_compute(user_question, complete, namespace="answer", metadata=metadata)
+        return content.strip()
     except Exception as e:
         logger.exception(f"Failed to generate answer: {e}")
         return "There was an error while generating the final answer."
 
-@traceable(name="handle_routed_query")
-def handle_routed_query(user_question, chat_memory_dict=None):
-    logger.info(f"Handling new question: {user_question}")
-    logger.info(f"Chat memory provided: {chat_memory_dict}")
+def _discard_prefetch(task):
+    """Cancel a data load routing didn't pick; one that already failed is logged, not left unretrieved."""
+    task.cancel()
+    task.add_done_callback(_log_prefetch_error)
 
-    # Step 0: Check for general message
-    if is_general_message(user_question):
-        return generate_friendly_reply(user_question)
+def _log_prefetch_error(task):
+    if not task.cancelled() and task.exception() is not None:
+        logger.warning(f"Prefetch failed: {task.exception()}")
 
-    def run_query(query, memory=None):
-        logger.info("Invoking routing logic...")
-        route_info = route_query_with_function_call(query, chat_memory_dict=memory)
+@traceable(name="handle_routed_query", process_inputs=redact_inputs("chat_memory_dict", "history_messages"))
+async def handle_routed_query(user_question, chat_memory_dict=None, history_messages=None, stream=False):
+    """
+    Answer a user question. With stream=True, synthesized answers come back as
+    an async generator of text deltas; canned and backend replies stay strings.
+    """
+    logger.info(f"Handling new question: {user_question}")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Chat memory provided: %s", chat_memory_dict)
+
+    # Format the chat history once for every helper in this request
+    if history_messages is None:
+        history_messages = build_history_messages(chat_memory_dict)
+    history_str = render_history(chat_memory_dict)
+
+    # Step 0: Check for general message while routing runs in parallel
+    routing = asyncio.create_task(route_query_with_function_call(user_question, history_messages=history_messages))
+    if await is_general_message(user_question):
+        routing.cancel()
+        return await generate_friendly_reply(user_question)
+
+    # Warm the SQL and Firestore data while routing finishes; the load routing doesn't pick is cancelled
+    prefetch = {
+        "sql": asyncio.create_task(asyncio.to_thread(get_sqlite_conn)),
+        "firestore": asyncio.create_task(get_feedback_snapshot("feedback_feedback"))
+    }
+    route_info = await routing
+    for name in [name for name in prefetch if name != route_info.get("destination")]:
+        _discard_prefetch(prefetch.pop(name))
+
+    async def run_query(query, memory=None, route_info=None):
+        if route_info is None:
+            logger.info("Invoking routing logic...")
+            route_info = await route_query_with_function_call(query, history_messages=history_messages if memory else None)
         destination = route_info.get("destination")
         property_mention = route_info.get("property_mention")
         agent_mention = route_info.get("agent_mention")
@@ -203,31 +286,37 @@ def handle_routed_query(user_question, chat_memory_dict=None):
         try:
             if destination == "sql":
                 logger.info("Routing to SQL backend...")
-                conn = get_sqlite_conn()
-                result = handle_user_question(query, conn, property_mention, agent_mention, memory)
-                logger.info(f"SQL result: {result}")
+                warmed = prefetch.pop("sql", None)
+                conn = await warmed if warmed else await asyncio.to_thread(get_sqlite_conn)
+                result = await handle_user_question(query, conn, property_mention, agent_mention, memory)
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("SQL result: %s", result)
                 return result, destination
 
             elif destination == "firestore":
                 logger.info("Routing to Firestore backend...")
-                result = handle_user_feedback_query(
+                warmed = prefetch.pop("firestore", None)
+                if warmed:
+                    await warmed
+                result = await handle_user_feedback_query(
                     user_question=query,
                     collection_name="feedback_feedback",
                     property_mention=property_mention,
                     agent_mention=agent_mention,
                     chat_memory_dict=memory
                 )
-                logger.info(f"Firestore result: {result}")
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("Firestore result: %s", result)
                 return result, destination
 
             elif destination == "faiss":
                 logger.info("Routing to FAISS backend...")
-                result = search_property_pdfs(faiss_index, query, property_mention, chat_memory_dict=memory)
+                result = await search_property_pdfs(faiss_index, query, property_mention, history_str=history_str if memory else None)
                 if "error" in result or not result.get("context"):
                     logger.warning("FAISS returned no results or context was empty.")
                     return None, destination
                 logger.info("Passing FAISS context to LLM for final answer...")
-                return generate_answer_from_context(query, result["context"], client), destination
+                return await generate_answer_from_context(query, result["context"], client, stream=stream), destination
 
             logger.warning("Destination was unrecognized.")
             return "Invalid routing destination.", "invalid"
@@ -237,16 +326,19 @@ def handle_routed_query(user_question, chat_memory_dict=None):
             return "An error occurred while processing your query.", "error"
 
     # Primary run
-    result, destination = run_query(user_question, memory=chat_memory_dict)
-
-    if result and (not isinstance(result, str) or "no relevant" not in result.lower()):
-        return generate_natural_answer(user_question, result) if isinstance(result, list) else result
-
-    # Fallback with chat memory
-    if chat_memory_dict:
-        logger.info("Trying fallback with full chat history...")
-        fallback_result, _ = run_query(user_question, memory=chat_memory_dict)
+    result, destination = await run_query(user_question, memory=chat_memory_dict, route_info=route_info)
+
+    if result:
+        if isinstance(result, list):
+            return await generate_natural_answer(user_question, result, stream=stream)
+        if not isinstance(result, str) or "no relevant" not in result.lower():
+            return result
+
+    # Fallback without chat memory, only when the primary run came back empty
+    if not result and chat_memory_dict:
+        logger.info("Trying fallback without chat history...")
+        fallback_result, _ = await run_query(user_question, memory=None)
         if fallback_result:
-            return generate_natural_answer(user_question, fallback_result) if isinstance(fallback_result, list) else fallback_result
+            return await generate_natural_answer(user_question, fallback_result, stream=stream) if isinstance(fallback_result, list) else fallback_result
 
     return f"Sorry, no relevant information found for: **{user_question}**."
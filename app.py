@@ -1,16 +1,19 @@
 import os
 import streamlit as st
 import logging
-from agent_router import handle_routed_query
 from dotenv import load_dotenv
 
-# Load environment variables
+# Load environment variables; tracing is decided when common is first imported,
+# so set it before the app modules load (LANGSMITH_TRACING=false turns it off)
 load_dotenv()
-os.environ["LANGSMITH_TRACING"] = "true"
+os.environ.setdefault("LANGSMITH_TRACING", "true")
 os.environ["LANGSMITH_API_KEY"] = os.getenv("LANGSMITH_API_KEY")
 os.environ["LANGSMITH_PROJECT"] = os.getenv("LANGSMITH_PROJECT", "Finance project")
 os.environ["LANGSMITH_ENDPOINT"] = os.getenv("LANGSMITH_ENDPOINT", "https://api.smith.langchain.com")
 
+from agent_router import handle_routed_query
+from common import run_async, iterate_async
+
 # Setup logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("streamlit-ui")
@@ -29,22 +32,23 @@ You can ask about:
 ---
 """)
 
-# Init session memory
+# Init session memory: chat_history holds chat-completions messages,
+# chat_memory_dict the q{i}/a{i} form used by the backends
 if "chat_history" not in st.session_state:
     st.session_state.chat_history = []
+    st.session_state.chat_memory_dict = {}
 
 # Reset conversation
 if st.button("New Chat"):
     st.session_state.chat_history = []
+    st.session_state.chat_memory_dict = {}
     st.success("Started a new conversation.")
     logger.info("[Session] Chat history reset by user.")
 
 # Display existing chat history
-for q, a in st.session_state.chat_history:
-    with st.chat_message("user"):
-        st.markdown(q)
-    with st.chat_message("assistant"):
-        st.markdown(a)
+for message in st.session_state.chat_history:
+    with st.chat_message(message["role"]):
+        st.markdown(message["content"])
 
 # Input
 user_question = st.chat_input("Ask me anything about your business...")
@@ -55,25 +59,39 @@ if user_question:
 
     with st.spinner("Analyzing your data..."):
         try:
-            # Convert history list of tuples to chat_memory_dict
-            chat_memory_dict = {}
-            for i, (q, a) in enumerate(st.session_state.chat_history, start=1):
-                chat_memory_dict[f"q{i}"] = q
-                chat_memory_dict[f"a{i}"] = a
-
             # Log question
             logger.info(f"[User Question] {user_question}")
 
             # Run routed query
-            answer = handle_routed_query(user_question, chat_memory_dict=chat_memory_dict)
-
-            # Save response
-            st.session_state.chat_history.append((user_question, answer))
-
+            answer_stream = run_async(handle_routed_query(
+                user_question,
+                chat_memory_dict=st.session_state.chat_memory_dict,
+                history_messages=st.session_state.chat_history,
+                stream=True
+            ))
+
+            # Render the answer as it streams in
             with st.chat_message("assistant"):
-                st.markdown(answer)
+                placeholder = st.empty()
+                if isinstance(answer_stream, str):
+                    answer = answer_stream
+                else:
+                    answer = ""
+                    for delta in iterate_async(answer_stream):
+                        answer += delta
+                        placeholder.markdown(answer)
+                placeholder.markdown(answer)
 
-            logger.info(f"[Answer] {answer}")
+            # Save response
+            turn = len(st.session_state.chat_memory_dict) // 2 + 1
+            st.session_state.chat_memory_dict[f"q{turn}"] = user_question
+            st.session_state.chat_memory_dict[f"a{turn}"] = answer
+            st.session_state.chat_history.extend([
+                {"role": "user", "content": user_question},
+                {"role": "assistant", "content": answer}
+            ])
+
+            logger.debug("[Answer] %s", answer)
 
         except Exception as e:
             logger.exception("[Error] Failed to process user query.")
@@ -0,0 +1,215 @@
+import os
+import re
+import json
+import asyncio
+import hashlib
+import weakref
+import threading
+from functools import lru_cache
+import httpx
+from dotenv import load_dotenv
+from openai import AsyncOpenAI
+from langchain_openai import OpenAIEmbeddings
+
+try:
+    import orjson
+except ImportError:  # optional: fall back to the stdlib encoder
+    orjson = None
+
+# Load keys once for every module
+load_dotenv()
+
+
+# --- Tracing ---
+# Decided once at import: with tracing off, @traceable leaves functions untouched
+# instead of wrapping every call in span bookkeeping
+TRACING_ENABLED = os.getenv("LANGSMITH_TRACING", "").lower() in ("1", "true")
+
+if TRACING_ENABLED:
+    from langsmith import traceable
+else:
+    def traceable(*args, **kwargs):
+        """No-op stand-in for langsmith.traceable, usable bare or with arguments."""
+        if len(args) == 1 and callable(args[0]) and not kwargs:
+            return args[0]
+        return lambda func: func
+
+
+# --- Models ---
+# Routing, classification and extraction are simple tasks; answer synthesis stays on gpt-4 / gpt-4o
+MODEL_CLASSIFY = "gpt-4o-mini"
+EMBEDDING_MODEL = "text-embedding-ada-002"
+# Smaller embeddings for the local prototype classifiers
+CLASSIFIER_EMBEDDING_MODEL = "text-embedding-3-small"
+
+
+# --- Shared HTTP connection pools ---
+@lru_cache(maxsize=1)
+def get_http_client():
+    return httpx.Client(http2=True, timeout=30)
+
+
+@lru_cache(maxsize=1)
+def get_async_http_client():
+    return httpx.AsyncClient(http2=True, timeout=30)
+
+
+# --- OpenAI clients ---
+@lru_cache(maxsize=1)
+def get_async_openai_client():
+    return AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), http_client=get_async_http_client())
+
+
+@lru_cache(maxsize=None)
+def get_embeddings(model=EMBEDDING_MODEL):
+    # One embeddings request carries up to 2048 chunks
+    return OpenAIEmbeddings(
+        model=model,
+        api_key=os.getenv("OPENAI_API_KEY"),
+        chunk_size=2048,
+        http_client=get_http_client(),
+        http_async_client=get_async_http_client()
+    )
+
+
+# --- JSON ---
+def json_loads(data):
+    return orjson.loads(data) if orjson else json.loads(data)
+
+
+def json_dumps(obj, sort_keys=False):
+    """Compact JSON text; non-serializable values (timestamps, numpy scalars) fall back to str."""
+    if orjson:
+        return orjson.dumps(obj, default=str, option=orjson.OPT_SORT_KEYS if sort_keys else 0).decode()
+    return json.dumps(obj, default=str, sort_keys=sort_keys, separators=(",", ":"), ensure_ascii=False)
+
+
+# --- Chat memory ---
+_PUNCT = re.compile(r"[^\w\s]")
+
+
+def question_key(question):
+    """Case, punctuation and spacing-insensitive form of a question, for exact cache reuse."""
+    return " ".join(_PUNCT.sub(" ", question.lower()).split())
+
+
+def render_history(chat_memory_dict):
+    """Render {q1, a1, q2, a2, ...} chat memory as "User: ...\nAssistant: ..." lines in one pass."""
+    if not chat_memory_dict:
+        return ""
+    return "\n".join(
+        f"User: {chat_memory_dict[f'q{i}']}\nAssistant: {chat_memory_dict[f'a{i}']}"
+        for i in range(1, len(chat_memory_dict) // 2 + 1)
+    )
+
+
+def build_history_messages(chat_memory_dict):
+    """The same chat memory as alternating user/assistant chat messages."""
+    messages = []
+    for i in range(1, len(chat_memory_dict or {}) // 2 + 1):
+        messages.append({"role": "user", "content": chat_memory_dict[f"q{i}"]})
+        messages.append({"role": "assistant", "content": chat_memory_dict[f"a{i}"]})
+    return messages
+
+
+def last_turn_hash(chat_memory_dict):
+    """Fingerprint of the latest question/answer pair, so cached replies only match the same context."""
+    if not chat_memory_dict:
+        return ""
+    turn = len(chat_memory_dict) // 2
+    last = f"{chat_memory_dict.get(f'q{turn}')}\n{chat_memory_dict.get(f'a{turn}')}"
+    return hashlib.sha1(last.encode()).hexdigest()
+
+
+# --- Trace payloads ---
+def _summarize(value):
+    if isinstance(value, (list, tuple, dict)):
+        return f"<{type(value).__name__} of {len(value)} items>"
+    if isinstance(value, str) and len(value) > 500:
+        return f"<str of {len(value)} chars>"
+    return value
+
+
+def redact_inputs(*fields):
+    """process_inputs for @traceable: log only the size of heavy arguments such as chat history."""
+    def process(inputs):
+        return {key: _summarize(value) if key in fields else value for key, value in inputs.items()}
+    return process
+
+
+def redact_outputs(outputs):
+    """process_outputs for @traceable: log only the size of row/record results."""
+    if isinstance(outputs, dict) and list(outputs) == ["output"]:
+        outputs = outputs["output"]
+    return {"output": _summarize(outputs)}
+
+
+def json_schema_format(name, properties):
+    """response_format for a strict structured output whose fields are all required."""
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": name,
+            "strict": True,
+            "schema": {
+                "type": "object",
+                "properties": properties,
+                "required": list(properties),
+                "additionalProperties": False
+            }
+        }
+    }
+
+
+# --- OpenAI concurrency ---
+# Every session shares one loop, so one semaphore per loop bounds in-flight
+# requests across users and keeps bursts under the API rate limits
+OPENAI_CONCURRENCY = 16
+_semaphores = weakref.WeakKeyDictionary()  # event loop -> asyncio.Semaphore
+
+
+def openai_semaphore():
+    loop = asyncio.get_running_loop()
+    semaphore = _semaphores.get(loop)
+    if semaphore is None:
+        semaphore = _semaphores[loop] = asyncio.Semaphore(OPENAI_CONCURRENCY)
+    return semaphore
+
+
+async def chat_completion(client, **kwargs):
+    """client.chat.completions.create, bounded by the shared concurrency limit."""
+    async with openai_semaphore():
+        return await client.chat.completions.create(**kwargs)
+
+
+async def stream_chat_completion(client, **kwargs):
+    """Yield the text deltas of a streamed chat completion; the stream holds a slot until it ends."""
+    async with openai_semaphore():
+        response = await client.chat.completions.create(stream=True, **kwargs)
+        async for chunk in response:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+
+# --- Shared event loop ---
+# Async clients keep pooled connections tied to the loop that opened them,
+# so sync callers (Streamlit, notebooks) run every coroutine on one loop.
+@lru_cache(maxsize=1)
+def _background_loop():
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="async-loop", daemon=True).start()
+    return loop
+
+
+def run_async(coro):
+    """Run a coroutine on the shared background loop and wait for its result."""
+    return asyncio.run_coroutine_threadsafe(coro, _background_loop()).result()
+
+
+def iterate_async(agen):
+    """Iterate an async generator from sync code, one item at a time on the shared loop."""
+    while True:
+        try:
+            yield run_async(agen.__anext__())
+        except StopAsyncIteration:
+            return
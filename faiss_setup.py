@@ -1,34 +1,139 @@
 import os
-from PyPDF2 import PdfReader
-from langchain_openai import OpenAIEmbeddings
+import uuid
+import shutil
+import hashlib
+import faiss
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+import pypdfium2 as pdfium
 from langchain_community.vectorstores import FAISS
+from langchain_community.docstore.in_memory import InMemoryDocstore
 from langchain_core.documents import Document
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from dotenv import load_dotenv
-from langsmith import traceable  
+from common import get_embeddings, traceable
+
+# Below this many chunks an exact flat index is both fast and exact;
+# above it, switch to a compressed IVF+PQ index
+IVFPQ_MIN_VECTORS = 10000
+IVFPQ_NPROBE = 8
+
+# Top-level so it can be pickled into worker processes
+def _extract_pdf_text(pdf_path):
+    pdf = pdfium.PdfDocument(pdf_path)
+    try:
+        return ' '.join([page.get_textpage().get_text_range() for page in pdf])
+    finally:
+        pdf.close()
+
+# Combine the per-property indexes into one index tagged with each chunk's property
+def _merge_indexes(faiss_indexes, embeddings, merged_path):
+    texts, vectors, metadatas = [], [], []
+    for pid, store in faiss_indexes.items():
+        vectors.extend(store.index.reconstruct_n(0, store.index.ntotal).tolist())
+        for i in range(store.index.ntotal):
+            doc = store.docstore.search(store.index_to_docstore_id[i])
+            texts.append(doc.page_content)
+            metadatas.append({**doc.metadata, "pid": pid})
+
+    if len(vectors) < IVFPQ_MIN_VECTORS:
+        return FAISS.from_embeddings(list(zip(texts, vectors)), embeddings, metadatas=metadatas)
+
+    # Training is the slow part, so keep the trained index until a PDF changes
+    store = _build_ivfpq_index(texts, np.array(vectors, dtype="float32"), metadatas, embeddings)
+    shutil.rmtree(os.path.dirname(merged_path), ignore_errors=True)
+    store.save_local(merged_path)
+    return store
+
+# IVF+PQ: ~10x less memory and much faster search for ~1% recall loss.
+# L2 matches LangChain's default distance and ranks unit-norm OpenAI vectors like inner product.
+def _build_ivfpq_index(texts, vectors, metadatas, embeddings):
+    dim = vectors.shape[1]
+    quantizer = faiss.IndexFlatL2(dim)
+    index = faiss.IndexIVFPQ(quantizer, dim, min(100, len(vectors) // 40), 16, 8)
+    index.train(vectors)
+    index.add(vectors)
+    index.nprobe = IVFPQ_NPROBE
+
+    ids = [str(uuid.uuid4()) for _ in texts]
+    docstore = InMemoryDocstore({
+        doc_id: Document(page_content=text, metadata=metadata)
+        for doc_id, text, metadata in zip(ids, texts, metadatas)
+    })
+    return FAISS(embeddings, index, docstore, dict(enumerate(ids)))
+
+# Positions of each property's chunks in the merged index
+def property_rows(store):
+    rows = {}
+    for i, doc_id in store.index_to_docstore_id.items():
+        rows.setdefault(store.docstore.search(doc_id).metadata["pid"], []).append(i)
+    return {pid: np.array(ids, dtype="int64") for pid, ids in rows.items()}
+
+def search_rows(store, query_vector, rows, k):
+    """
+    Top-k chunks among `rows` only. The selector restricts the scan itself, and an
+    IVF index probes every list, so a filtered search never misses a property's chunks.
+    """
+    rows = np.ascontiguousarray(rows, dtype="int64")
+    selector = faiss.IDSelectorBatch(len(rows), faiss.swig_ptr(rows))
+    if isinstance(store.index, faiss.IndexIVF):
+        params = faiss.SearchParametersIVF(sel=selector, nprobe=store.index.nlist)
+    else:
+        params = faiss.SearchParameters(sel=selector)
+    _, ids = store.index.search(np.array([query_vector], dtype="float32"), min(k, len(rows)), params=params)
+    return [store.docstore.search(store.index_to_docstore_id[i]) for i in ids[0] if i != -1]
 
 @traceable(name="create_faiss_indexes_from_folder")
-def create_faiss_indexes_from_folder(folder_path="data/Property_details", chunk_size=1000, overlap=200):
-    load_dotenv()
-    openai_api_key = os.getenv("OPENAI_API_KEY")
-    embeddings = OpenAIEmbeddings(api_key=openai_api_key)
+def create_faiss_indexes_from_folder(folder_path="data/Property_details", chunk_size=1000, overlap=200, cache_dir="cache/faiss"):
+    embeddings = get_embeddings()
 
     splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=overlap)
 
     faiss_indexes = {}
+    to_build = {}  # index_name -> (pdf_path, index_path)
+    pdf_hashes = {}  # index_name -> (pdf_path, pdf_hash)
 
     for filename in os.listdir(folder_path):
         if filename.endswith('.pdf'):
             pdf_path = os.path.join(folder_path, filename)
             with open(pdf_path, 'rb') as f:
-                reader = PdfReader(f)
-                text = ' '.join([page.extract_text() for page in reader.pages if page.extract_text()])
+                pdf_hash = hashlib.md5(f.read() + f"{chunk_size}:{overlap}".encode()).hexdigest()
+            pdf_hashes[filename.replace('.pdf', '')] = (pdf_path, pdf_hash)
+
+    # A saved merged IVF+PQ index is only valid for exactly this set of PDFs
+    merged_key = hashlib.md5("\n".join(f"{name}:{h}" for name, (_, h) in sorted(pdf_hashes.items())).encode()).hexdigest()
+    merged_path = os.path.join(cache_dir, "_merged", merged_key)
+    if os.path.exists(merged_path):
+        store = FAISS.load_local(merged_path, embeddings, allow_dangerous_deserialization=True)
+        store.index.nprobe = IVFPQ_NPROBE
+        return store
+
+    for index_name, (pdf_path, pdf_hash) in pdf_hashes.items():
+        # Reuse the saved index unless the PDF (or chunking) changed
+        index_path = os.path.join(cache_dir, index_name, pdf_hash)
+        if os.path.exists(index_path):
+            faiss_indexes[index_name] = FAISS.load_local(index_path, embeddings, allow_dangerous_deserialization=True)
+        else:
+            to_build[index_name] = (pdf_path, index_path)
+
+    if to_build:
+        # PDF parsing is CPU-bound, so extract all new PDFs in parallel
+        pdf_paths = [pdf_path for pdf_path, _ in to_build.values()]
+        with ProcessPoolExecutor() as executor:
+            texts = dict(zip(pdf_paths, executor.map(_extract_pdf_text, pdf_paths)))
+
+        for index_name, (pdf_path, index_path) in to_build.items():
+            chunks = splitter.split_text(texts[pdf_path])
+            vectors = embeddings.embed_documents(chunks)
+            faiss_index = FAISS.from_embeddings(
+                list(zip(chunks, vectors)),
+                embeddings,
+                metadatas=[{"id": i} for i in range(len(chunks))]
+            )
 
-            chunks = splitter.split_text(text)
-            documents = [Document(page_content=chunk) for chunk in chunks]
-            faiss_index = FAISS.from_documents(documents, embeddings)
+            # Drop indexes built from older versions of this PDF
+            shutil.rmtree(os.path.join(cache_dir, index_name), ignore_errors=True)
+            faiss_index.save_local(index_path)
 
-            index_name = filename.replace('.pdf', '')
             faiss_indexes[index_name] = faiss_index
 
-    return faiss_indexes
+    return _merge_indexes(faiss_indexes, embeddings, merged_path)
@@ -1,38 +1,76 @@
-import os
 import re
-import json
+import asyncio
 import logging
-from dotenv import load_dotenv
+from functools import lru_cache
+import numpy as np
 from langchain_community.vectorstores import FAISS
-from langchain_openai import OpenAIEmbeddings
-from faiss_setup import create_faiss_indexes_from_folder
-from openai import OpenAI
-from langsmith import traceable
+from common import MODEL_CLASSIFY, CLASSIFIER_EMBEDDING_MODEL, traceable, get_async_openai_client, chat_completion, get_embeddings, stream_chat_completion, json_schema_format, redact_inputs, json_loads
+from faiss_setup import create_faiss_indexes_from_folder, property_rows, search_rows
+from local_classifier import PrototypeClassifier
+from query_helpers import select_top_properties
 
 # Setup
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
-load_dotenv()
-openai_api_key = os.getenv("OPENAI_API_KEY")
 
 # Init
-client = OpenAI(api_key=openai_api_key)
-embeddings = OpenAIEmbeddings(api_key=openai_api_key)
+client = get_async_openai_client()
+_PROP_RE = re.compile(r"property\s*(?:id)?\s*(\d+)", re.I)
+# Structured outputs for the extraction/classification helpers
+HISTORY_FORMAT = json_schema_format("history_check", {"needs_history": {"type": "boolean"}})
+MENTIONS_FORMAT = json_schema_format("property_mentions", {"property_ids": {"type": "array", "items": {"type": "integer"}}})
+COUNT_FORMAT = json_schema_format("requested_count", {"count": {"type": "integer"}})
+_COUNT_RE = re.compile(r"\b(?:top|first|best)\s+(\d+)\b|\b(\d+)\s+(?:properties|results|items|homes|houses|listings|options)\b", re.I)
+embeddings = get_embeddings()
+classifier_embeddings = get_embeddings(CLASSIFIER_EMBEDDING_MODEL)
 faiss_index = create_faiss_indexes_from_folder()
+_property_rows = property_rows(faiss_index)
+
+history_classifier = PrototypeClassifier(
+    {
+        "yes": [
+            "tell me more about this property",
+            "what about the one mentioned earlier",
+            "do those properties have a gym",
+            "does it have parking",
+            "which of them has a pool",
+            "the one above",
+            "compare them",
+            "what amenities does that one have",
+            "is it furnished",
+            "and the second one?",
+        ],
+        "no": [
+            "list top properties",
+            "what do customers say in general",
+            "what are agent reviews",
+            "which properties have a community hall",
+            "show me properties with a swimming pool",
+            "what amenities does property 5 have",
+            "find furnished properties",
+            "properties near schools",
+            "which properties are pet friendly",
+            "overall, which properties have the best amenities",
+        ],
+    },
+    classifier_embeddings,
+)
 
 
 # --- Decide whether to use chat history ---
 @traceable(name="should_use_chat_history")
-def should_use_chat_history(user_question):
+async def should_use_chat_history(user_question):
+    label = await asyncio.to_thread(history_classifier.classify, user_question)
+    if label is not None:
+        return label == "yes"
+
     system_prompt = """
 You are an assistant that decides whether a user's question requires previous chat history to be understood.
 
 Instructions:
-- If the question contains vague references like "those properties", "the one mentioned earlier", "this property", "it", or "them", return "yes".
-- If the question is standalone or general like "what do customers say in general", "list top properties", "what are agent reviews", return "no".
+- If the question contains vague references like "those properties", "the one mentioned earlier", "this property", "it", or "them", set needs_history to true.
+- If the question is standalone or general like "what do customers say in general", "list top properties", "what are agent reviews", set needs_history to false.
 - Ignore phrases like "in general", "overall", "typically" — they do NOT require chat history unless tied to a specific earlier reference.
-
-ONLY return "yes" or "no".
 """
 
     try:
@@ -40,47 +78,43 @@ ONLY return "yes" or "no".
             {"role": "system", "content": system_prompt},
             {"role": "user", "content": user_question}
         ]
-        response = client.chat.completions.create(model="gpt-4", messages=messages, temperature=0)
-        result = response.choices[0].message.content.strip().lower()
-        return result == "yes"
+        response = await chat_completion(
+            client, model=MODEL_CLASSIFY, messages=messages, temperature=0, max_tokens=16, response_format=HISTORY_FORMAT
+        )
+        return json_loads(response.choices[0].message.content)["needs_history"]
     except Exception as e:
         logger.warning(f"[FAISS] Error checking memory use: {e}")
         return False
 
 
 # --- Extract property mentions ---
-@traceable(name="extract_property_mentions")
-def extract_property_mentions(user_question, chat_memory_dict=None):
+@traceable(name="extract_property_mentions", process_inputs=redact_inputs("history_str"))
+async def extract_property_mentions(user_question, history_str=None):
     system_prompt = """
     You are an assistant that extracts property references from the user's current question and the past conversation history.
 
     Instructions:
-    - Return property identifiers only in the form: "property 1", "property 2", etc.
+    - Return property numbers only, e.g. 5 for "property 5".
     - If the user's question is vague or references previously discussed properties, then extract the relevant property IDs from the chat history.
     - If the user's question is standalone and doesn't reference earlier context, extract any property numbers explicitly stated in the question.
     - If nothing is mentioned or implied, return an empty list.
-
-    Respond strictly with a JSON list, like:
-    ["property 5", "property 9"]
-    or
-    []
     """
 
     messages = [{"role": "system", "content": system_prompt}]
-    if chat_memory_dict:
-        history = "\n".join([f"User: {chat_memory_dict[f'q{i}']}\nAssistant: {chat_memory_dict[f'a{i}']}" 
-                             for i in range(1, len(chat_memory_dict)//2 + 1)])
-        logger.info(f"[FAISS] Passing chat history:\n{history}")
-        messages.append({"role": "user", "content": f"{history}\n{user_question}"})
+    if history_str:
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("[FAISS] Passing chat history:\n%s", history_str)
+        messages.append({"role": "user", "content": f"{history_str}\n{user_question}"})
     else:
         messages.append({"role": "user", "content": user_question})
 
     try:
         logger.info(f"[FAISS] Extracting property mentions from: {user_question}")
-        response = client.chat.completions.create(model="gpt-4", messages=messages, temperature=0)
-        raw_content = response.choices[0].message.content.strip()
-        matches = re.findall(r'property\s*(?:id)?\s*(\d+)', raw_content.lower())
-        cleaned = [f"property {m}" for m in matches]
+        response = await chat_completion(
+            client, model=MODEL_CLASSIFY, messages=messages, temperature=0, response_format=MENTIONS_FORMAT
+        )
+        property_ids = json_loads(response.choices[0].message.content)["property_ids"]
+        cleaned = [f"property {n}" for n in property_ids]
         logger.info(f"[FAISS] Cleaned property mentions: {cleaned}")
         return cleaned
     except Exception as e:
@@ -89,19 +123,25 @@ def extract_property_mentions(user_question, chat_memory_dict=None):
 
 
 # --- Search FAISS PDFs ---
-@traceable(name="search_property_pdfs")
-def search_property_pdfs(faiss_indexes, user_question, property_mention=None, chat_memory_dict=None, max_results=3):
+# Repeat and fallback searches for the same question reuse its embedding
+@lru_cache(maxsize=256)
+def _embed_query(user_question):
+    return embeddings.embed_query(user_question)
+
+
+@traceable(name="search_property_pdfs", process_inputs=redact_inputs("history_str"))
+async def search_property_pdfs(faiss_index, user_question, property_mention=None, history_str=None, max_results=3):
     logger.info(f"[FAISS] Searching PDFs for: {user_question}")
     docs = []
     doc_sources = []
 
-    use_memory = should_use_chat_history(user_question)
+    use_memory = await should_use_chat_history(user_question)
     logger.info(f"[FAISS] Use chat history? {use_memory}")
 
-    memory_to_use = chat_memory_dict if use_memory else None
-    mentions = extract_property_mentions(user_question, memory_to_use)
+    memory_to_use = history_str if use_memory else None
+    mentions = await extract_property_mentions(user_question, memory_to_use)
 
-    explicit_mentions = re.findall(r'property\s*(?:id)?\s*\d+', user_question.lower())
+    explicit_mentions = _PROP_RE.findall(user_question)
     if not mentions and not explicit_mentions:
         mentions = []
 
@@ -109,40 +149,38 @@ def search_property_pdfs(faiss_indexes, user_question, property_mention=None, ch
 
     valid_keys = []
     for mention in mentions:
-        match = re.search(r"property\s*(?:id)?\s*(\d+)", mention)
+        match = _PROP_RE.search(mention)
         if match:
             valid_keys.append(f"Property_ID_{match.group(1)}")
 
+    query_vector = await asyncio.to_thread(_embed_query, user_question)
+
     if valid_keys:
         logger.info(f"[FAISS] Valid keys: {valid_keys}")
-        for key in valid_keys:
-            if key in faiss_indexes:
-                results = faiss_indexes[key].similarity_search(user_question, k=2)
-                docs.extend(results)
-                doc_sources.extend([(key, d.page_content) for d in results])
-            else:
-                logger.warning(f"[FAISS] Property key not found: {key}")
+        valid_key_set = frozenset(valid_keys)
+        # Top 2 chunks per referenced property, so one property can't crowd out another
+        keys = [key for key in dict.fromkeys(valid_keys) if key in _property_rows]
+        results = await asyncio.to_thread(
+            lambda: [doc for key in keys for doc in search_rows(faiss_index, query_vector, _property_rows[key], 2)]
+        )
+        docs.extend(results)
+        doc_sources.extend([(d.metadata["pid"], d.page_content) for d in results])
+
+        for key in valid_key_set - {pid for pid, _ in doc_sources}:
+            logger.warning(f"[FAISS] Property key not found: {key}")
     else:
         logger.warning("[FAISS] No valid property IDs found. Running similarity search across all properties.")
-        all_ranked = []
-
-        for pid, idx in faiss_indexes.items():
-            results = idx.similarity_search(user_question, k=2)
-            for res in results:
-                all_ranked.append((pid, res))
-
-        # Collect top N properties
-        unique_properties = {}
-        for pid, doc in all_ranked:
-            if pid not in unique_properties and len(unique_properties) < max_results:
-                unique_properties[pid] = [doc.page_content]
-            elif pid in unique_properties and len(unique_properties[pid]) < 2:
-                unique_properties[pid].append(doc.page_content)
-
-        for pid, contents in unique_properties.items():
-            for c in contents:
-                docs.append(c)
-                doc_sources.append((pid, c))
+        # Over-fetch so enough distinct properties survive the per-property cap below
+        results = await asyncio.to_thread(faiss_index.similarity_search_by_vector, query_vector, k=max_results * 4)
+        all_ranked = [(doc.metadata["pid"], doc) for doc in results]
+
+        # Collect top N properties, at most 2 chunks each
+        codes = {}
+        pids_int = np.array([codes.setdefault(pid, len(codes)) for pid, _ in all_ranked], dtype=np.int64)
+        for i in select_top_properties(pids_int, len(codes), max_results, 2):
+            pid, doc = all_ranked[i]
+            docs.append(doc.page_content)
+            doc_sources.append((pid, doc.page_content))
 
     if not docs:
         return {"error": "No matching documents found."}
@@ -160,14 +198,22 @@ def search_property_pdfs(faiss_indexes, user_question, property_mention=None, ch
 
 
 # --- Extract requested count ---
-def extract_requested_count_via_llm(user_question: str, client, default=3) -> int:
+_count_cache = {}  # question -> count from the LLM, capped at COUNT_CACHE_SIZE entries
+COUNT_CACHE_SIZE = 256
+
+async def extract_requested_count_via_llm(user_question: str, client, default=3) -> int:
+    # Most phrasings ("top 5", "3 properties") are caught without an LLM call
+    match = _COUNT_RE.search(user_question)
+    if match:
+        return int(match.group(1) or match.group(2))
+    if user_question in _count_cache:
+        return _count_cache[user_question]
+
     system_prompt = """
 You are an assistant that extracts how many properties the user is asking for in their question.
 
 - If they mention an exact number, return that number.
 - If no number is mentioned, return the default: 3.
-
-Respond with only the number. No words, no explanation.
 """
     messages = [
         {"role": "system", "content": system_prompt},
@@ -175,14 +221,19 @@ Respond with only the number. No words, no explanation.
     ]
 
     try:
-        response = client.chat.completions.create(
-            model="gpt-4",
+        response = await chat_completion(
+            client,
+            model=MODEL_CLASSIFY,
             messages=messages,
-            temperature=0
+            temperature=0,
+            max_tokens=16,
+            response_format=COUNT_FORMAT
         )
-        content = response.choices[0].message.content.strip()
-        match = re.search(r'\d+', content)
-        return int(match.group()) if match else default
+        count = json_loads(response.choices[0].message.content)["count"] or default
+        if len(_count_cache) >= COUNT_CACHE_SIZE:
+            _count_cache.pop(next(iter(_count_cache)))
+        _count_cache[user_question] = count
+        return count
     except Exception as e:
         print(f"LLM count extraction error: {e}")
         return default
@@ -190,8 +241,8 @@ Respond with only the number. No words, no explanation.
 
 # --- Generate final answer from context ---
 @traceable(name="generate_answer_from_context")
-def generate_answer_from_context(user_question, context, client):
-    requested_count = extract_requested_count_via_llm(user_question, client, default=3)
+async def generate_answer_from_context(user_question, context, client, stream=False):
+    requested_count = await extract_requested_count_via_llm(user_question, client, default=3)
     
     prompt = f"""
 You are a real estate assistant that answers property-related questions using the provided PDF excerpts.
@@ -212,12 +263,20 @@ Instructions:
 
 Answer:
 """
+    request = {"model": "gpt-4", "messages": [{"role": "user", "content": prompt}], "temperature": 0.3}
+
+    if stream:
+        async def stream_answer():
+            try:
+                async for delta in stream_chat_completion(client, **request):
+                    yield delta
+            except Exception:
+                logger.exception("[FAISS] Error generating final answer")
+                yield "There was an error while generating the answer."
+        return stream_answer()
+
     try:
-        response = client.chat.completions.create(
-            model="gpt-4",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.3
-        )
+        response = await chat_completion(client, **request)
         return response.choices[0].message.content.strip()
     except Exception as e:
         logger.exception("[FAISS] Error generating final answer")
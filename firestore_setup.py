@@ -4,6 +4,8 @@ from google.cloud import firestore
 from dotenv import load_dotenv
 from langsmith import traceable  
 
+BATCH_SIZE = 450
+
 # @traceable will log this function execution
 @traceable(name="upload_feedback_jsons_to_firestore")
 def upload_feedback_jsons_to_firestore(
@@ -27,8 +29,14 @@ def upload_feedback_jsons_to_firestore(
             base_name = os.path.splitext(filename)[0]  
             collection_name = f"{base_name}_feedback"
 
-            for feedback in feedback_list:
+            # Commit in batches to avoid one round-trip per document (Firestore allows 500 writes per batch)
+            batch = db.batch()
+            for i, feedback in enumerate(feedback_list, start=1):
                 doc_id = f"agent_{feedback['agent_id']}_property_{feedback['property_id']}"
-                db.collection(collection_name).document(doc_id).set(feedback)
+                batch.set(db.collection(collection_name).document(doc_id), feedback)
+                if i % BATCH_SIZE == 0:
+                    batch.commit()
+                    batch = db.batch()
+            batch.commit()
 
     return db
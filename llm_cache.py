@@ -0,0 +1,230 @@
+import os
+import pickle
+import asyncio
+import logging
+import itertools
+import threading
+from collections import OrderedDict
+import numpy as np
+import faiss
+
+logger = logging.getLogger(__name__)
+
+
+class SemanticLLMCache:
+    """
+    Caches LLM responses keyed by the embedding of the prompt.
+
+    Each namespace (one per call site) has its own inner-product FAISS index over
+    L2-normalized prompt embeddings, so a lookup is a cosine-similarity search.
+    A cached response is reused when a match scores above `threshold` and its
+    metadata agrees with the caller's, so prompts that embed alike but were
+    answered from different data never share a response.
+
+    Each namespace holds at most `max_entries` responses; past that, the least
+    recently used tenth is dropped, which also retires entries from old data versions.
+    """
+
+    def __init__(self, embeddings, path="cache/llm", threshold=0.95, max_entries=1000):
+        self.embeddings = embeddings
+        self.path = path
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self._indexes = {}  # namespace -> faiss.IndexFlatIP
+        self._entries = {}  # namespace -> [(prompt, response, metadata), ...]
+        self._last_used = {}  # namespace -> [tick, ...], parallel to _entries
+        self._ticks = itertools.count()
+        self._lock = threading.Lock()  # sync callers insert from worker threads
+        self.load()
+
+    def _embed(self, prompt_key):
+        vec = np.array([self.embeddings.embed_query(" ".join(prompt_key.lower().split()))], dtype="float32")
+        faiss.normalize_L2(vec)
+        return vec
+
+    def _lookup(self, namespace, vec, metadata=None):
+        # Under the lock, since eviction swaps a namespace's index and entries together
+        with self._lock:
+            index = self._indexes.get(namespace)
+            if index is None or index.ntotal == 0:
+                return None
+            # Every entry above the threshold, best first: a prompt cached under many
+            # contexts must still find the variant whose metadata matches
+            _, scores, ids = index.range_search(vec, self.threshold)
+            for j in np.argsort(-scores, kind="stable"):
+                score, i = scores[j], ids[j]
+                _, response, entry_metadata = self._entries[namespace][i]
+                if metadata and any(entry_metadata.get(key) != value for key, value in metadata.items()):
+                    continue
+                self._last_used[namespace][i] = next(self._ticks)
+                logger.info(f"[Cache] Hit in '{namespace}' (score={score:.3f})")
+                return response
+            return None
+
+    def _insert(self, namespace, vec, prompt_key, response, metadata=None):
+        with self._lock:
+            if namespace not in self._indexes:
+                self._entries[namespace] = []
+                self._last_used[namespace] = []
+                self._indexes[namespace] = faiss.IndexFlatIP(vec.shape[1])
+            self._entries[namespace].append((prompt_key, response, metadata or {}))
+            self._last_used[namespace].append(next(self._ticks))
+            self._indexes[namespace].add(vec)
+            if len(self._entries[namespace]) > self.max_entries:
+                self._evict(namespace)
+
+    def _evict(self, namespace):
+        """Keep the most recently used 90% of `max_entries`, rebuilding the flat index from them."""
+        last_used = self._last_used[namespace]
+        keep = sorted(sorted(range(len(last_used)), key=last_used.__getitem__)[-(self.max_entries * 9 // 10):])
+        index = self._indexes[namespace]
+        rebuilt = faiss.IndexFlatIP(index.d)
+        rebuilt.add(index.reconstruct_n(0, index.ntotal)[keep])
+        self._indexes[namespace] = rebuilt
+        self._entries[namespace] = [self._entries[namespace][i] for i in keep]
+        self._last_used[namespace] = [last_used[i] for i in keep]
+        logger.info(f"[Cache] Evicted {len(last_used) - len(keep)} entries from '{namespace}'")
+
+    def get_or_compute(self, prompt_key, compute, namespace="default", metadata=None, cache_if=None):
+        try:
+            vec = self._embed(prompt_key)
+        except Exception as e:
+            logger.warning(f"[Cache] Embedding failed, bypassing cache: {e}")
+            return compute()
+
+        cached = self._lookup(namespace, vec, metadata)
+        if cached is not None:
+            return cached
+
+        response = compute()
+        if cache_if is None or cache_if(response):
+            self._insert(namespace, vec, prompt_key, response, metadata)
+        return response
+
+    async def aget_or_compute(self, prompt_key, compute, namespace="default", metadata=None, cache_if=None):
+        """Async variant of get_or_compute; `compute` is a coroutine function."""
+        try:
+            vec = await asyncio.to_thread(self._embed, prompt_key)
+        except Exception as e:
+            logger.warning(f"[Cache] Embedding failed, bypassing cache: {e}")
+            return await compute()
+
+        cached = self._lookup(namespace, vec, metadata)
+        if cached is not None:
+            return cached
+
+        response = await compute()
+        if cache_if is None or cache_if(response):
+            self._insert(namespace, vec, prompt_key, response, metadata)
+        return response
+
+    async def astream_or_compute(self, prompt_key, stream, namespace="default", metadata=None):
+        """
+        Streaming variant: yields a cached response whole, or the text deltas of
+        `stream()` (an async generator function) and caches their concatenation.
+        """
+        try:
+            vec = await asyncio.to_thread(self._embed, prompt_key)
+        except Exception as e:
+            logger.warning(f"[Cache] Embedding failed, bypassing cache: {e}")
+            vec = None
+
+        cached = self._lookup(namespace, vec, metadata) if vec is not None else None
+        if cached is not None:
+            yield cached
+            return
+
+        parts = []
+        async for delta in stream():
+            parts.append(delta)
+            yield delta
+        if vec is not None:
+            self._insert(namespace, vec, prompt_key, "".join(parts), metadata)
+
+    def save(self):
+        if not self._indexes:
+            return
+        os.makedirs(self.path, exist_ok=True)
+        with self._lock:
+            for namespace, index in self._indexes.items():
+                faiss.write_index(index, os.path.join(self.path, f"{namespace}.index"))
+            with open(os.path.join(self.path, "entries.pkl"), "wb") as f:
+                pickle.dump(self._entries, f)
+        logger.info(f"[Cache] Saved {sum(len(e) for e in self._entries.values())} entries to {self.path}")
+
+    def load(self):
+        entries_path = os.path.join(self.path, "entries.pkl")
+        if not os.path.exists(entries_path):
+            return
+        try:
+            with open(entries_path, "rb") as f:
+                entries = pickle.load(f)
+            for namespace in entries:
+                self._indexes[namespace] = faiss.read_index(os.path.join(self.path, f"{namespace}.index"))
+                # Saved order stands in for recency; the newest entries evict last
+                self._last_used[namespace] = [next(self._ticks) for _ in entries[namespace]]
+            self._entries = entries
+            logger.info(f"[Cache] Loaded {sum(len(e) for e in entries.values())} entries from {self.path}")
+        except Exception as e:
+            logger.warning(f"[Cache] Failed to load cache from {self.path}: {e}")
+            self._indexes, self._entries, self._last_used = {}, {}, {}
+
+
+class ResponseCache:
+    """
+    Exact-key LRU cache for handler responses, persisted across restarts.
+
+    The caller builds the key from the normalized question and everything the answer
+    depends on, so a lookup is a dict access with no embedding round-trip.
+    """
+
+    def __init__(self, path, max_entries=1000):
+        self.path = path
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> response, least recently used first
+        self._lock = threading.Lock()
+        self.load()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            logger.info(f"[Cache] Hit in {self.path}")
+            return self._entries[key]
+
+    def put(self, key, response):
+        with self._lock:
+            self._entries[key] = response
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    async def aget_or_compute(self, key, compute, cache_if=None):
+        """`compute` is a coroutine function; its result is stored when `cache_if` allows."""
+        cached = self.get(key)
+        if cached is not None:
+            return cached
+        response = await compute()
+        if cache_if is None or cache_if(response):
+            self.put(key, response)
+        return response
+
+    def save(self):
+        if not self._entries:
+            return
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with self._lock, open(self.path, "wb") as f:
+            pickle.dump(self._entries, f)
+        logger.info(f"[Cache] Saved {len(self._entries)} entries to {self.path}")
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "rb") as f:
+                self._entries = pickle.load(f)
+            logger.info(f"[Cache] Loaded {len(self._entries)} entries from {self.path}")
+        except Exception as e:
+            logger.warning(f"[Cache] Failed to load cache from {self.path}: {e}")
+            self._entries = OrderedDict()
@@ -0,0 +1,84 @@
+import logging
+from functools import lru_cache
+import numpy as np
+from common import CLASSIFIER_EMBEDDING_MODEL, get_embeddings
+
+logger = logging.getLogger(__name__)
+
+
+class PrototypeClassifier:
+    """
+    Nearest-prototype classifier over embeddings.
+
+    Each label has a handful of example phrases. A message gets the label of the
+    most similar example, or None when nothing is similar enough so the caller
+    can fall back to an LLM.
+    """
+
+    def __init__(self, prototypes, embeddings, min_similarity=0.5):
+        self.prototypes = prototypes  # label -> [example phrases]
+        self.embeddings = embeddings
+        self.min_similarity = min_similarity
+        # The router and the SQL handler classify the same question; embed it once
+        self._embed_query = lru_cache(maxsize=256)(embeddings.embed_query)
+        self._matrix = None
+        self._labels = None
+
+    def _prototype_matrix(self):
+        # Embedded once, on first use
+        if self._matrix is None:
+            texts, labels = [], []
+            for label, examples in self.prototypes.items():
+                texts.extend(examples)
+                labels.extend([label] * len(examples))
+            matrix = np.array(self.embeddings.embed_documents(texts), dtype="float32")
+            self._matrix = matrix / np.linalg.norm(matrix, axis=1, keepdims=True)
+            self._labels = labels
+        return self._matrix
+
+    def classify(self, text):
+        try:
+            matrix = self._prototype_matrix()
+            vec = np.array(self._embed_query(text), dtype="float32")
+            scores = matrix @ (vec / np.linalg.norm(vec))
+        except Exception as e:
+            logger.warning(f"[Classifier] Embedding failed: {e}")
+            return None
+
+        best = int(np.argmax(scores))
+        if scores[best] < self.min_similarity:
+            logger.info(f"[Classifier] Low confidence ({scores[best]:.2f}) for: {text}")
+            return None
+        return self._labels[best]
+
+
+# Local general/business classifier, shared by the router and the SQL handler
+general_classifier = PrototypeClassifier(
+    {
+        "general": [
+            "hi",
+            "hello",
+            "hey there",
+            "good morning",
+            "how are you",
+            "what's up",
+            "thanks",
+            "what can you do",
+            "what kind of datasets do you have",
+            "what do you know",
+        ],
+        "business": [
+            "what are the top 3 properties",
+            "which city has the most expensive houses",
+            "what is the average sale price of a 2 bedroom house",
+            "which agent sold the most properties",
+            "what do customers say about agent 3",
+            "does property 5 have a swimming pool",
+            "which properties were listed the longest",
+            "show feedback for property 2",
+            "which properties have a community hall",
+            "how did agent 1 perform",
+        ],
+    },
+    get_embeddings(CLASSIFIER_EMBEDDING_MODEL),
+)
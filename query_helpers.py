@@ -0,0 +1,103 @@
+import re
+import operator
+import functools
+import numpy as np
+from common import json_loads, json_dumps
+
+try:
+    from numba import njit
+except ImportError:  # installed from requirements.txt; without it the selection runs as plain Python
+    njit = None
+
+# Pure helpers shared by the feedback and PDF handlers; they make no client or network calls at import
+
+
+# --- ID mentions ---
+_DIGITS = re.compile(r"\d+")
+
+def to_int_list(raw):
+    """Normalize an ID mention (3, "property 3 and 5", or a list of either) to a list of ints."""
+    match raw:
+        case bool():  # an int subclass, but never an ID
+            return []
+        case int():
+            return [raw]
+        case str():
+            return [int(x) for x in _DIGITS.findall(raw)]
+        case list() | tuple():
+            return [n for item in raw for n in to_int_list(item)]
+        case _:
+            return []
+
+
+# --- Filter predicates ---
+# The LLM describes a filter as a small JSON tree that is compiled into vectorized
+# column operations on the snapshot frame, so generated text is never executed as code
+FILTER_FIELDS = frozenset({"property_id", "agent_id", "property_feedback", "agent_feedback"})
+_COMPARISONS = {
+    "eq": operator.eq, "ne": operator.ne,
+    "lt": operator.lt, "le": operator.le, "gt": operator.gt, "ge": operator.ge
+}
+
+def _compile_node(node):
+    op = node["op"]
+    if op in ("and", "or"):
+        masks = tuple(_compile_node(arg) for arg in node["args"])
+        combine = operator.and_ if op == "and" else operator.or_
+        return lambda frame: functools.reduce(combine, (mask(frame) for mask in masks))
+    if op == "not":
+        mask = _compile_node(node["arg"])
+        return lambda frame: ~mask(frame)
+
+    field = node["field"]
+    if field not in FILTER_FIELDS:
+        raise ValueError(f"Unknown filter field: {field}")
+    value = node.get("value")
+
+    if op == "in":
+        # A string would otherwise become a set of its characters
+        if not isinstance(value, list) or any(isinstance(item, (list, dict)) for item in value):
+            raise ValueError(f"'in' needs a list of values, got: {value!r}")
+        allowed = list(frozenset(value))
+        return lambda frame: frame[field].isin(allowed).fillna(False).astype(bool)
+    if op == "contains":
+        needle = str(value)
+        return lambda frame: frame[field].str.contains(needle, case=False, regex=False).fillna(False).astype(bool)
+    if op in _COMPARISONS:
+        compare = _COMPARISONS[op]
+        return lambda frame: compare(frame[field], value).fillna(False).astype(bool)
+    raise ValueError(f"Unknown filter op: {op}")
+
+@functools.lru_cache(maxsize=256)
+def _compile_canonical(canonical):
+    return _compile_node(json_loads(canonical))
+
+def compile_predicate(tree):
+    """Compile a filter tree into a frame -> boolean mask function; identical trees share one compiled filter."""
+    return _compile_canonical(json_dumps(tree, sort_keys=True))
+
+
+# --- Ranked hit selection ---
+def select_top_properties(pids_int, n_pids, max_results, per_property):
+    """Indices into the ranked hits keeping the first `max_results` distinct pids, up to `per_property` hits each."""
+    taken = np.zeros(n_pids, dtype=np.int64)
+    selected = np.empty(len(pids_int), dtype=np.int64)
+    n_selected = 0
+    n_seen = 0
+    for i in range(len(pids_int)):
+        pid = pids_int[i]
+        if taken[pid] == 0:
+            if n_seen >= max_results:
+                continue
+            n_seen += 1
+        if taken[pid] < per_property:
+            taken[pid] += 1
+            selected[n_selected] = i
+            n_selected += 1
+    # Codes follow first-seen order, so a stable sort groups chunks by property in rank order
+    order = np.argsort(pids_int[selected[:n_selected]], kind="mergesort")
+    return selected[:n_selected][order]
+
+
+if njit is not None:
+    select_top_properties = njit(cache=True)(select_top_properties)
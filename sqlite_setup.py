@@ -1,14 +1,45 @@
 # import required libraries
+import os
 import sqlite3
+import threading
 import pandas as pd
-from langsmith import traceable  
+from common import traceable
+
+# Connection reused across questions until the CSV changes
+_CONN = None
+_CSV_MTIME = 0
+# Callers run in worker threads, so only one of them rebuilds the table
+_LOCK = threading.Lock()
 
 @traceable(name="get_sqlite_conn")
 def get_sqlite_conn(csv_path="data/real_estate_data.csv", db_path="real_estate.db"):
+    with _LOCK:
+        return _load_conn(csv_path, db_path)
+
+def _load_conn(csv_path, db_path):
+    global _CONN, _CSV_MTIME
+
+    mtime = os.path.getmtime(csv_path)
+    if _CONN is not None and mtime == _CSV_MTIME:
+        return _CONN
+
     df = pd.read_csv(csv_path)
-    conn = sqlite3.connect(db_path)
+    # Shared by Streamlit sessions and worker threads
+    conn = sqlite3.connect(db_path, check_same_thread=False)
+    # WAL lets readers run alongside the rebuild; mmap keeps hot pages in memory (256 MB)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA mmap_size=268435456")
 
     # Write DataFrame to SQLite
     df.to_sql("real_estate", conn, if_exists="replace", index=False)
+    # Generated SQL only ever reads
+    conn.execute("PRAGMA query_only=1")
 
+    # The old connection isn't closed here: queries on other threads may still be reading it,
+    # so it is released by garbage collection once the last of them drops it
+    _CONN, _CSV_MTIME = conn, mtime
     return conn
+
+# Changes whenever the table is rebuilt from a newer CSV
+def get_sqlite_data_version():
+    return _CSV_MTIME
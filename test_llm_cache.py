@@ -0,0 +1,97 @@
+import asyncio
+import numpy as np
+import pytest
+from llm_cache import SemanticLLMCache, ResponseCache
+
+
+class OneHotEmbeddings:
+    """Each distinct text gets its own basis vector, so only identical prompts are similar."""
+
+    def __init__(self, dim=64):
+        self.dim = dim
+        self.texts = {}
+
+    def embed_query(self, text):
+        vec = np.zeros(self.dim, dtype="float32")
+        vec[self.texts.setdefault(text, len(self.texts))] = 1.0
+        return vec.tolist()
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return SemanticLLMCache(OneHotEmbeddings(), path=str(tmp_path / "llm"), threshold=0.9, max_entries=10)
+
+
+def lookup(cache, prompt, metadata=None):
+    """Cached response for prompt, or None; a miss stores "computed"."""
+    calls = []
+    response = cache.get_or_compute(prompt, lambda: calls.append(1) or "computed", metadata=metadata)
+    return None if calls else response
+
+
+def test_every_metadata_variant_of_a_prompt_hits(cache):
+    for i in range(6):
+        cache.get_or_compute("same question", lambda: f"answer {i}", metadata={"last_turn": f"t{i}"})
+    for i in range(6):
+        assert lookup(cache, "same question", {"last_turn": f"t{i}"}) == f"answer {i}"
+
+
+def test_metadata_mismatch_recomputes(cache):
+    cache.get_or_compute("question", lambda: "old", metadata={"data_version": 1})
+    assert lookup(cache, "question", {"data_version": 2}) is None
+    assert lookup(cache, "question", {"data_version": 2}) == "computed"
+
+
+def test_unrelated_prompt_misses(cache):
+    cache.get_or_compute("question", lambda: "answer")
+    assert lookup(cache, "another question") is None
+
+
+def test_eviction_drops_least_recently_used(cache):
+    for i in range(10):
+        cache.get_or_compute(f"q{i}", lambda: f"a{i}")
+    assert lookup(cache, "q0") == "a0"  # q0 is now the most recently used
+    cache.get_or_compute("q10", lambda: "a10")  # over the cap: keep the newest 9
+
+    assert len(cache._entries["default"]) == 9
+    assert cache._indexes["default"].ntotal == 9
+    assert lookup(cache, "q0") == "a0"
+    assert lookup(cache, "q10") == "a10"
+    assert lookup(cache, "q1") is None
+
+
+def test_save_and_load_round_trip(cache):
+    cache.get_or_compute("question", lambda: "answer", metadata={"data_version": 1})
+    cache.save()
+
+    reloaded = SemanticLLMCache(cache.embeddings, path=cache.path, threshold=0.9)
+    assert lookup(reloaded, "question", {"data_version": 1}) == "answer"
+
+
+# --- ResponseCache ---
+def compute(value):
+    async def run():
+        return value
+    return run
+
+
+def test_response_cache_is_exact_and_least_recently_used(tmp_path):
+    cache = ResponseCache(path=str(tmp_path / "responses.pkl"), max_entries=2)
+    asyncio.run(cache.aget_or_compute(("q1", "v1"), compute("a1")))
+    asyncio.run(cache.aget_or_compute(("q2", "v1"), compute("a2")))
+    assert cache.get(("q1", "v2")) is None
+    assert cache.get(("q1", "v1")) == "a1"  # q1 is now the most recently used
+    asyncio.run(cache.aget_or_compute(("q3", "v1"), compute("a3")))
+    assert cache.get(("q2", "v1")) is None
+    assert cache.get(("q1", "v1")) == "a1"
+
+
+def test_response_cache_skips_uncacheable_and_round_trips(tmp_path):
+    cache = ResponseCache(path=str(tmp_path / "responses.pkl"))
+    asyncio.run(cache.aget_or_compute("error", compute("Error while"), cache_if=lambda r: not r.startswith("Error")))
+    asyncio.run(cache.aget_or_compute("ok", compute(["row"])))
+    cache.save()
+
+    reloaded = ResponseCache(path=cache.path)
+    assert reloaded.get("error") is None
+    assert reloaded.get("ok") == ["row"]
@@ -0,0 +1,91 @@
+import numpy as np
+import pandas as pd
+import pytest
+from query_helpers import compile_predicate, to_int_list, select_top_properties
+
+
+@pytest.fixture
+def frame():
+    frame = pd.DataFrame({
+        "property_id": [1, 2, 3, None],
+        "agent_id": [7, 8, 7, 9],
+        "property_feedback": ["Great POOL", None, "small kitchen", "pool was dirty"],
+        "agent_feedback": ["quick replies", "slow", None, "friendly"],
+    })
+    frame["property_id"] = frame["property_id"].astype("Int32")
+    frame["agent_id"] = frame["agent_id"].astype("Int32")
+    for column in ("property_feedback", "agent_feedback"):
+        frame[column] = frame[column].astype("string")
+    return frame
+
+
+# --- compile_predicate ---
+def test_in_matches_listed_ids(frame):
+    mask = compile_predicate({"op": "in", "field": "property_id", "value": [1, 3]})(frame)
+    assert mask.tolist() == [True, False, True, False]
+
+
+def test_contains_is_case_insensitive_and_false_for_missing(frame):
+    mask = compile_predicate({"op": "contains", "field": "property_feedback", "value": "pool"})(frame)
+    assert mask.tolist() == [True, False, False, True]
+
+
+def test_comparison_treats_missing_as_false(frame):
+    mask = compile_predicate({"op": "ge", "field": "property_id", "value": 2})(frame)
+    assert mask.tolist() == [False, True, True, False]
+
+
+def test_and_not_combine_masks(frame):
+    tree = {"op": "and", "args": [
+        {"op": "eq", "field": "agent_id", "value": 7},
+        {"op": "not", "arg": {"op": "contains", "field": "property_feedback", "value": "pool"}},
+    ]}
+    assert compile_predicate(tree)(frame).tolist() == [False, False, True, False]
+
+
+def test_identical_trees_share_one_compiled_filter():
+    tree = {"op": "eq", "field": "agent_id", "value": 7}
+    assert compile_predicate(tree) is compile_predicate(dict(reversed(list(tree.items()))))
+
+
+@pytest.mark.parametrize("value", ["12", 12, None, [[1, 2]]])
+def test_in_rejects_non_list_values(value):
+    with pytest.raises(ValueError):
+        compile_predicate({"op": "in", "field": "property_id", "value": value})
+
+
+@pytest.mark.parametrize("tree", [
+    {"op": "eq", "field": "__class__", "value": 1},
+    {"op": "regex", "field": "agent_id", "value": ".*"},
+])
+def test_unknown_fields_and_ops_are_rejected(tree):
+    with pytest.raises(ValueError):
+        compile_predicate(tree)
+
+
+# --- to_int_list ---
+@pytest.mark.parametrize("raw, expected", [
+    (3, [3]),
+    ("property 3 and 5", [3, 5]),
+    (["agent 2", 4, ("7",)], [2, 4, 7]),
+    (True, []),
+    (None, []),
+    (2.5, []),
+    ("no ids here", []),
+])
+def test_to_int_list(raw, expected):
+    assert to_int_list(raw) == expected
+
+
+# --- select_top_properties ---
+def test_select_top_properties_caps_properties_and_hits_per_property():
+    # Ranked hits by property code; codes follow first-seen order
+    pids = np.array([0, 1, 0, 2, 1, 0, 3], dtype=np.int64)
+    selected = select_top_properties(pids, 4, 2, 2)
+    # First two properties only, two hits each, grouped by property in rank order
+    assert selected.tolist() == [0, 2, 1, 4]
+
+
+def test_select_top_properties_with_fewer_hits_than_requested():
+    pids = np.array([0, 1], dtype=np.int64)
+    assert select_top_properties(pids, 2, 3, 2).tolist() == [0, 1]
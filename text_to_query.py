@@ -1,11 +1,16 @@
-import os
-import re
-import json
+import time
+import random
+import atexit
+import hashlib
+import asyncio
 import logging
+import pandas as pd
+from collections import namedtuple
 from dotenv import load_dotenv
 from google.cloud import firestore
-from openai import OpenAI
-from langsmith import traceable
+from common import MODEL_CLASSIFY, traceable, get_async_openai_client, chat_completion, json_schema_format, last_turn_hash, question_key, render_history, redact_inputs, redact_outputs, json_loads, json_dumps
+from llm_cache import ResponseCache
+from query_helpers import compile_predicate, to_int_list
 
 # Initialize logging
 logging.basicConfig(level=logging.INFO, format="%(levelname)s:%(name)s:%(message)s")
@@ -13,137 +18,182 @@ logger = logging.getLogger("text_to_query")
 
 # Load environment
 load_dotenv()
-openai_api_key = os.getenv("OPENAI_API_KEY")
-client = OpenAI(api_key=openai_api_key)
-
-# Firestore
-db = firestore.Client(database="nosqldb")
-
-@traceable(name="get_feedback_data_from_firestore")
-def get_feedback_data_from_firestore(collection_name="feedback_feedback"):
+client = get_async_openai_client()
+
+# Summaries get the stronger model
+MODEL_ANALYZE = "gpt-4o"
+
+# Answers to repeated questions, reused while the feedback data and chat context match
+response_cache = ResponseCache(path="cache/feedback_responses.pkl")
+atexit.register(response_cache.save)
+_UNCACHED_PREFIXES = ("Error while", "There was an error", "Generated filter failed", "Could not identify")
+
+# One structured call replaces the query-type, focus and mention classifiers.
+# Static prompts lead each request so the shared prefix is eligible for prompt caching
+CLASSIFY_PROMPT = """
+You interpret questions about real estate feedback.
+
+query_type:
+- "analysis" → the question asks for traits, behaviors, opinions or overall impressions
+  (e.g., "Which agent was responsive?", "Which property had the best reviews?")
+- "filter" → the question asks for specific entries or records
+  (e.g., "What did people say about property 3?", "Show me feedback for agent 1")
+
+feedback_focus:
+- "property" → feedback on a property (e.g., "What did people say about property 5?")
+- "agent" → feedback on an agent (e.g., "Was agent 3 helpful?")
+- "both" → both (e.g., "Feedback on property 2 and the agent")
+
+property_id / agent_id:
+- Every property and agent number mentioned in the current question or implied by the chat history,
+  as plain numbers (e.g., [5, 10]). Use an empty list if none.
+"""
+
+FILTER_PROMPT = """
+Translate a natural language question into a JSON filter over feedback entries.
+Each entry is a dict with keys:
+- property_id (int), agent_id (int), property_feedback (str), agent_feedback (str)
+
+A filter is one of:
+- {"op": "and" | "or", "args": [<filter>, ...]}
+- {"op": "not", "arg": <filter>}
+- {"field": <key>, "op": "eq" | "ne" | "lt" | "le" | "gt" | "ge", "value": <number or string>}
+- {"field": <key>, "op": "in", "value": [<values>]}
+- {"field": <key>, "op": "contains", "value": <text>}  (case-insensitive substring)
+
+Return only the JSON filter.
+"""
+
+CLASSIFY_FORMAT = json_schema_format("feedback_query", {
+    "query_type": {"type": "string", "enum": ["analysis", "filter"]},
+    "feedback_focus": {"type": "string", "enum": ["property", "agent", "both"]},
+    "property_id": {"type": "array", "items": {"type": "integer"}},
+    "agent_id": {"type": "array", "items": {"type": "integer"}}
+})
+
+# Firestore; cold loads split the collection into partitions read concurrently
+db = firestore.AsyncClient(database="nosqldb")
+FEEDBACK_PARTITIONS = 8
+
+# Feedback changes far slower than questions arrive, so reuse each collection's
+# snapshot for FEEDBACK_TTL seconds instead of streaming it on every query
+FEEDBACK_TTL = 60
+_feedback_cache = {}  # collection_name -> FeedbackSnapshot
+_feedback_locks = {}  # collection_name -> asyncio.Lock, so one request refreshes at a time
+
+# by_property / by_agent map an ID to the positions of its entries, built once per refresh;
+# frame holds the same entries column-wise (row i == entries[i]) for vectorized filters.
+# version fingerprints the entries so cached answers outlive refreshes that changed nothing
+FeedbackSnapshot = namedtuple("FeedbackSnapshot", ["fetched_at", "version", "entries", "frame", "by_property", "by_agent"])
+
+def _build_frame(entries):
+    frame = pd.DataFrame(list(entries), columns=["property_id", "agent_id", "property_feedback", "agent_feedback"])
+    for column in ("property_id", "agent_id"):
+        frame[column] = pd.to_numeric(frame[column], errors="coerce").astype("Int32")
+    for column in ("property_feedback", "agent_feedback"):
+        frame[column] = frame[column].astype("string")
+    return frame
+
+def _index_entries(entries, key):
+    index = {}
+    for i, entry in enumerate(entries):
+        index.setdefault(entry.get(key), []).append(i)
+    return index
+
+# Fields each feedback focus needs; the other feedback text never reaches the prompt
+FOCUS_FIELDS = {
+    "property": ("property_id", "agent_id", "property_feedback"),
+    "agent": ("property_id", "agent_id", "agent_feedback"),
+    "both": ("property_id", "agent_id", "property_feedback", "agent_feedback")
+}
+
+def project_entries(entries, feedback_focus="both"):
+    """Copies of the entries with only the fields the focus needs; the snapshot itself stays whole."""
+    fields = FOCUS_FIELDS.get(feedback_focus, FOCUS_FIELDS["both"])
+    return [{k: entry[k] for k in fields if k in entry} for entry in entries]
+
+def _sample_entries(entries, max_entries):
+    # Over the cap, an order-preserving random sample covers the whole set instead of only its head
+    if len(entries) <= max_entries:
+        return list(entries)
+    return [entries[i] for i in sorted(random.sample(range(len(entries)), max_entries))]
+
+async def _stream_partition(partition):
+    return [doc.to_dict() async for doc in partition.query().stream()]
+
+@traceable(name="get_feedback_snapshot", process_outputs=redact_outputs)
+async def get_feedback_snapshot(collection_name="feedback_feedback"):
+    cached = _feedback_cache.get(collection_name)
+    if cached and time.monotonic() - cached.fetched_at < FEEDBACK_TTL:
+        return cached
+
+    # Concurrent cold or expired loads wait for the first one instead of each streaming the collection
+    async with _feedback_locks.setdefault(collection_name, asyncio.Lock()):
+        cached = _feedback_cache.get(collection_name)
+        if cached and time.monotonic() - cached.fetched_at < FEEDBACK_TTL:
+            return cached
+        return await _refresh_feedback_snapshot(collection_name)
+
+async def _refresh_feedback_snapshot(collection_name):
     logger.info(f"Fetching feedback data from Firestore collection: {collection_name}")
-    docs = db.collection(collection_name).stream()
-    return [doc.to_dict() for doc in docs]
-
-@traceable(name="classify_query_type")
-def classify_query_type(user_question):
-    prompt = """
-    You are an assistant that classifies real estate-related feedback questions into two types:
-
-    1. "analysis" → The question asks for:
-    - identifying traits or behaviors (e.g., "Which agent was responsive?")
-    - opinions or qualities (e.g., "Who had clear communication?", "Which property had the best reviews?")
-    - overall impressions
-
-    2. "filter" → The question asks for:
-    - specific entries or records (e.g., "What did people say about property 3?", "Show me feedback for agent 1")
-
-    Return only one word: analysis or filter.
-    """
+    # Partitions come back in document order, so the flattened entries keep a stable order
+    partitions = [p async for p in db.collection_group(collection_name).get_partitions(FEEDBACK_PARTITIONS)]
+    chunks = await asyncio.gather(*(_stream_partition(p) for p in partitions))
+    # A tuple so callers can't reorder or extend the shared snapshot; entries are copied before editing
+    entries = tuple(entry for chunk in chunks for entry in chunk)
+    # Hashing and frame building are CPU-bound, so they run off the shared event loop
+    snapshot = await asyncio.to_thread(_build_snapshot, entries)
+    _feedback_cache[collection_name] = snapshot
+    return snapshot
+
+def _build_snapshot(entries):
+    version = hashlib.sha1(json_dumps(entries, sort_keys=True).encode()).hexdigest()
+    return FeedbackSnapshot(
+        time.monotonic(), version, entries, _build_frame(entries),
+        _index_entries(entries, "property_id"), _index_entries(entries, "agent_id")
+    )
+
+@traceable(name="classify_and_extract", process_inputs=redact_inputs("chat_memory_dict"))
+async def classify_and_extract(user_question, chat_memory_dict):
+    """Query type, feedback focus and mentioned IDs in a single structured call."""
+    history = render_history(chat_memory_dict)
+    prompt = f"--- Chat History ---\n{history}\n--- Current Question ---\n{user_question}"
 
     try:
-        response = client.chat.completions.create(
-            model="gpt-4",
-            messages=[{"role": "system", "content": prompt}, {"role": "user", "content": user_question}],
-            temperature=0
+        response = await chat_completion(
+            client,
+            model=MODEL_CLASSIFY,
+            messages=[{"role": "system", "content": CLASSIFY_PROMPT}, {"role": "user", "content": prompt}],
+            temperature=0,
+            response_format=CLASSIFY_FORMAT
         )
-        label = response.choices[0].message.content.strip().lower()
-        return label if label in {"analysis", "filter"} else "filter"
+        content = response.choices[0].message.content
+        logger.debug(f"LLM classification response: {content}")
+        return json_loads(content)
     except Exception:
-        logger.exception("Failed to classify query type.")
-        return "filter"
-
-@traceable(name="classify_feedback_focus")
-def classify_feedback_focus(user_question):
-    prompt = """
-    You identify whether the user is asking about feedback on:
-    - a property → return 'property'
-    - an agent → return 'agent'
-    - or both → return 'both'
-
-    Examples:
-    - "What did people say about property 5?" → property
-    - "Was agent 3 helpful?" → agent
-    - "Feedback on property 2 and the agent" → both
-
-    Return one word only: property, agent, or both.
-    """
-    try:
-        response = client.chat.completions.create(
-            model="gpt-4",
-            messages=[{"role": "system", "content": prompt}, {"role": "user", "content": user_question}],
-            temperature=0
-        )
-        result = response.choices[0].message.content.strip().lower()
-        return result if result in {"property", "agent", "both"} else "both"
-    except Exception:
-        logger.exception("Failed to classify feedback focus.")
-        return "both"
-    
-@traceable(name="infer_mentions_and_context")
-def infer_mentions_and_context(user_question, chat_memory_dict):
-    history = ""
-    for i in range(1, len(chat_memory_dict) // 2 + 1):
-        history += f"User: {chat_memory_dict[f'q{i}']}\nAssistant: {chat_memory_dict[f'a{i}']}\n"
-
-    prompt = f"""
-    You are an assistant that extracts all **mentioned property and agent IDs** from the user's current question and chat history.
-
-    Your response must be a JSON object with:
-    - "property_id": a list of property numbers (e.g., [5, 10, 12]) or null if none found
-    - "agent_id": a list of agent numbers (e.g., [1, 3]) or null if none found
+        logger.exception("Failed to classify feedback query.")
+        return {"query_type": "filter", "feedback_focus": "both", "property_id": [], "agent_id": []}
 
-    Do not return strings like "property 1". Just the numbers in a list.
 
-    If nothing is mentioned, return:
-    {{ "property_id": null, "agent_id": null }}
-
-    --- Chat History ---
-    {history}
-    --- Current Question ---
-    {user_question}
-    """
-
-    try:
-        response = client.chat.completions.create(
-            model="gpt-4",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0
-        )
-        content = response.choices[0].message.content.strip()
-        logger.debug(f"LLM mention extraction response: {content}")
-        return json.loads(content)
-    except Exception:
-        logger.exception("Failed to infer mentions.")
-        return {"property_id": None, "agent_id": None}
-
-
-
-@traceable(name="generate_filter_code")
-def generate_filter_code(user_question):
-    schema = """
-    Translate a natural language question into a Python list comprehension.
-    Each entry is a dict with keys:
-    - property_id (int), agent_id (int), property_feedback (str), agent_feedback (str)
-
-    Return:
-    [entry for entry in data if <condition>]
-    """
+@traceable(name="generate_filter_predicate")
+async def generate_filter_predicate(user_question):
     try:
-        response = client.chat.completions.create(
-            model="gpt-4",
-            messages=[{"role": "system", "content": schema}, {"role": "user", "content": user_question}],
-            temperature=0
+        response = await chat_completion(
+            client,
+            model=MODEL_CLASSIFY,
+            messages=[{"role": "system", "content": FILTER_PROMPT}, {"role": "user", "content": user_question}],
+            temperature=0,
+            response_format={"type": "json_object"}
         )
-        generated_code = response.choices[0].message.content.strip()
-        logger.info(f"Generated filter code: {generated_code}")
-        return generated_code
+        content = response.choices[0].message.content
+        logger.info(f"Generated filter: {content}")
+        return json_loads(content)
     except Exception:
-        logger.exception("Failed to generate filter code.")
+        logger.exception("Failed to generate filter.")
         return None
 
 
-def extract_trait_summary(user_question, data, feedback_focus="both", max_entries=100):
+async def extract_trait_summary(user_question, data, feedback_focus="both", max_entries=100):
     prompt = f"""
     You are an assistant that reads feedback entries and answers the question: "{user_question}"
 
@@ -157,13 +207,14 @@ def extract_trait_summary(user_question, data, feedback_focus="both", max_entrie
     Only refer to agent numbers if necessary (e.g., Agent 3), or say "multiple agents" or "some agents" if general.
 
     Use only the {max_entries} entries below:
-    {json.dumps(data[:max_entries], indent=2)}
+    {json_dumps(project_entries(_sample_entries(data, max_entries), feedback_focus))}
 
     Answer:
     """
     try:
-        response = client.chat.completions.create(
-            model="gpt-4",
+        response = await chat_completion(
+            client,
+            model=MODEL_ANALYZE,
             messages=[{"role": "user", "content": prompt}],
             temperature=0.5
         )
@@ -172,19 +223,11 @@ def extract_trait_summary(user_question, data, feedback_focus="both", max_entrie
         logger.exception("Failed to extract traits.")
         return "Could not identify specific traits from feedback."
 
-@traceable(name="generate_feedback_analysis")
-def generate_feedback_analysis(user_question, data, chat_memory_dict, feedback_focus="both", max_entries=120):
-    data = data[:max_entries]
-    if feedback_focus == "property":
-        for entry in data:
-            entry.pop("agent_feedback", None)
-    elif feedback_focus == "agent":
-        for entry in data:
-            entry.pop("property_feedback", None)
+@traceable(name="generate_feedback_analysis", process_inputs=redact_inputs("data", "chat_memory_dict"))
+async def generate_feedback_analysis(user_question, data, chat_memory_dict, feedback_focus="both", max_entries=120):
+    data = project_entries(_sample_entries(data, max_entries), feedback_focus)
 
-    history = ""
-    for i in range(1, len(chat_memory_dict) // 2 + 1):
-        history += f"User: {chat_memory_dict[f'q{i}']}\nAssistant: {chat_memory_dict[f'a{i}']}\n"
+    history = render_history(chat_memory_dict)
 
     prompt = f"""
     Summarize relevant real estate feedback.
@@ -196,13 +239,14 @@ def generate_feedback_analysis(user_question, data, chat_memory_dict, feedback_f
     {history}
 
     Feedback data:
-    {json.dumps(data, indent=2)}
+    {json_dumps(data)}
 
     Answer clearly and concisely.
     """
     try:
-        response = client.chat.completions.create(
-            model="gpt-4",
+        response = await chat_completion(
+            client,
+            model=MODEL_ANALYZE,
             messages=[{"role": "user", "content": prompt}],
             temperature=0.5
         )
@@ -211,68 +255,68 @@ def generate_feedback_analysis(user_question, data, chat_memory_dict, feedback_f
         logger.exception("Failed to summarize feedback.")
         return "There was an error while summarizing the feedback."
     
-@traceable(name="handle_user_feedback_query")
-def handle_user_feedback_query(user_question, collection_name="feedback_feedback", property_mention=None, agent_mention=None, chat_memory_dict=None):
+@traceable(name="handle_user_feedback_query", process_inputs=redact_inputs("chat_memory_dict"))
+async def handle_user_feedback_query(user_question, collection_name="feedback_feedback", property_mention=None, agent_mention=None, chat_memory_dict=None):
     logger.info(f"Handling feedback query: {user_question}")
-    data = get_feedback_data_from_firestore(collection_name)
-    if not data:
+    snapshot = await get_feedback_snapshot(collection_name)
+    if not snapshot.entries:
         return "The feedback dataset is empty."
 
-    mentions = infer_mentions_and_context(user_question, chat_memory_dict or {})
-    prop_id_raw = property_mention or mentions.get("property_id")
-    agent_id_raw = agent_mention or mentions.get("agent_id")
-
-    # Normalize property_id to a list of integers
-    prop_ids = []
-    if isinstance(prop_id_raw, str):
-        prop_ids = [int(x.strip()) for x in re.findall(r'\d+', prop_id_raw)]
-    elif isinstance(prop_id_raw, list):
-        prop_ids = [int(x) for x in prop_id_raw if isinstance(x, (str, int))]
-    elif isinstance(prop_id_raw, int):
-        prop_ids = [prop_id_raw]
-
-    # Normalize agent_id to a list of integers
-    agent_ids = []
-    if isinstance(agent_id_raw, str):
-        agent_ids = [int(x.strip()) for x in re.findall(r'\d+', agent_id_raw)]
-    elif isinstance(agent_id_raw, list):
-        agent_ids = [int(x) for x in agent_id_raw if isinstance(x, (str, int))]
-    elif isinstance(agent_id_raw, int):
-        agent_ids = [agent_id_raw]
-
-    query_type = classify_query_type(user_question)
-    feedback_focus = classify_feedback_focus(user_question)
+    # A cached answer only counts for the same normalized question, mentions, previous turn and
+    # unchanged data; "agent 3" vs "agent 4" or "best" vs "worst" never share an answer
+    key = (
+        question_key(user_question), str(property_mention), str(agent_mention),
+        last_turn_hash(chat_memory_dict), snapshot.version
+    )
+    return await response_cache.aget_or_compute(
+        key,
+        lambda: _answer_feedback_query(user_question, snapshot, property_mention, agent_mention, chat_memory_dict),
+        cache_if=lambda answer: isinstance(answer, str) and not answer.startswith(_UNCACHED_PREFIXES)
+    )
+
+async def _answer_feedback_query(user_question, snapshot, property_mention, agent_mention, chat_memory_dict):
+    data = snapshot.entries
+    classification = await classify_and_extract(user_question, chat_memory_dict or {})
+
+    query_type = classification.get("query_type", "filter")
+    feedback_focus = classification.get("feedback_focus", "both")
+    prop_id_raw = property_mention or classification.get("property_id")
+    agent_id_raw = agent_mention or classification.get("agent_id")
+
+    prop_ids = frozenset(to_int_list(prop_id_raw))
+    agent_ids = frozenset(to_int_list(agent_id_raw))
 
     logger.info(f"Query Type: {query_type}, Feedback Focus: {feedback_focus}")
-    logger.info(f"Property IDs: {prop_ids}, Agent IDs: {agent_ids}")
+    logger.info(f"Property IDs: {sorted(prop_ids)}, Agent IDs: {sorted(agent_ids)}")
 
     try:
         if query_type == "analysis" and not (prop_ids or agent_ids):
-            return extract_trait_summary(user_question, data, feedback_focus)
+            return await extract_trait_summary(user_question, data, feedback_focus)
 
         filtered_data = []
-        if prop_ids and agent_ids:
-            filtered_data = [
-                e for e in data
-                if e.get("property_id") in prop_ids and e.get("agent_id") in agent_ids
-            ]
-        elif prop_ids:
-            filtered_data = [e for e in data if e.get("property_id") in prop_ids]
-        elif agent_ids:
-            filtered_data = [e for e in data if e.get("agent_id") in agent_ids]
+        if prop_ids or agent_ids:
+            # Look up entry positions in the snapshot's ID indexes instead of scanning every entry
+            prop_idxs = set().union(*(snapshot.by_property.get(p, ()) for p in prop_ids))
+            agent_idxs = set().union(*(snapshot.by_agent.get(a, ()) for a in agent_ids))
+            if prop_ids and agent_ids:
+                idxs = prop_idxs & agent_idxs
+            else:
+                idxs = prop_idxs or agent_idxs
+            filtered_data = [data[i] for i in sorted(idxs)]
         else:
-            code = generate_filter_code(user_question)
-            if code:
-                logger.info("Using custom filter generated by LLM:")
-                logger.info(f"Filter Code:\n{code}")
+            tree = await generate_filter_predicate(user_question)
+            if tree:
+                logger.info("Using custom filter generated by LLM.")
                 try:
-                    filtered_data = eval(code, {"data": data})
-                except Exception as eval_err:
-                    logger.exception("Error evaluating generated filter code.")
-                    return f"Generated filter code failed: {str(eval_err)}"
+                    mask = compile_predicate(tree)(snapshot.frame)
+                    # Hand the prompt the original entries, not rows rebuilt from the frame
+                    filtered_data = [data[i] for i in snapshot.frame.index[mask.to_numpy()]]
+                except Exception as filter_err:
+                    logger.exception("Error applying generated filter.")
+                    return f"Generated filter failed: {str(filter_err)}"
 
         if filtered_data:
-            return generate_feedback_analysis(user_question, filtered_data, chat_memory_dict, feedback_focus)
+            return await generate_feedback_analysis(user_question, filtered_data, chat_memory_dict, feedback_focus)
         return "Couldn't find relevant feedback in the dataset."
 
     except Exception as e:
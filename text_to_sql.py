@@ -1,53 +1,59 @@
-import os
-import json
+import re
+import atexit
+import asyncio
 import logging
 import sqlite3
-import pandas as pd
 import traceback
-from dotenv import load_dotenv
-from openai import OpenAI
-from sqlite_setup import get_sqlite_conn
-from langsmith import traceable  
+from sqlite_setup import get_sqlite_conn, get_sqlite_data_version
+from common import MODEL_CLASSIFY, traceable, get_async_openai_client, chat_completion, last_turn_hash, question_key, render_history, redact_inputs, redact_outputs
+from llm_cache import ResponseCache
+from local_classifier import general_classifier
 
 # Setup logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Load API key
-load_dotenv()
-openai_api_key = os.getenv("OPENAI_API_KEY")
-
-# Initialize OpenAI client
-client = OpenAI(api_key=openai_api_key)
+# Shared OpenAI client
+client = get_async_openai_client()
+
+# Rows for repeated questions, reused while the data and chat context match
+response_cache = ResponseCache(path="cache/sql_responses.pkl")
+atexit.register(response_cache.save)
+
+# Static prompts lead each request so the shared prefix is eligible for prompt caching
+SQL_SYSTEM_PROMPT = """
+You are a helpful assistant that converts natural language into valid SQLite SQL queries.
+
+The database has a table called `real_estate` with this schema:
+- purchase_id (INTEGER): Unique purchase identifier for a transaction.
+- property_id (INTEGER): Identifier for an apartment complex or property.
+- house_id (INTEGER): Identifier for a specific house/unit within a property. House ID may repeat across different properties.
+  To uniquely identify a house, use the combination of property_id and house_id.
+- date (TEXT): Date of purchase (format YYYY-MM-DD).
+- city (TEXT): City in Connecticut where the house is located.
+- agent_id (INTEGER): Identifier of the agent (values range across multiple agents; not sequential).
+- expected_sale_price (REAL): Expected price of the house, typically between 300,000 and 1,000,000.
+- actual_sale_price (REAL): Actual sold price, similar range as expected_sale_price.
+- number_of_days_on_listing (INTEGER): Days the house was listed before being sold.
+- number_of_beds (INTEGER): Number of bedrooms (2, 3, or 4).
+- number_of_baths (INTEGER): Number of bathrooms (2, 3, or 4).
+
+Your job is to:
+- Return a valid SQLite SQL query using this schema.
+- If the question includes phrases like "top N", "most", "least", "frequent", or "popular", use appropriate aggregation (e.g., COUNT) and sorting (e.g., ORDER BY COUNT DESC).
+- When calculating metrics like profit or prices across multiple houses, use `AVG()` or `SUM()` with aggregation
+- Always use aliases (e.g., AS house_count or AS most_common_city) for aggregated columns.
+- Do NOT include explanations, markdown, or comments. Only return the SQL query.
+"""
+
+CONTEXT_CHECK_PROMPT = """
+You are an assistant that decides whether a user's current question depends on earlier conversation context.
+Answer with only one word: "yes" if it needs previous context, otherwise "no".
+"""
 
 # Generate SQL from user query using GPT
-@traceable(name="generate_sql_query")
-def generate_sql_query(user_question, previous_query=None, error_msg=None):
-    schema = """
-    You are a helpful assistant that converts natural language into valid SQLite SQL queries.
-
-    The database has a table called `real_estate` with this schema:
-    - purchase_id (INTEGER): Unique purchase identifier for a transaction.
-    - property_id (INTEGER): Identifier for an apartment complex or property.
-    - house_id (INTEGER): Identifier for a specific house/unit within a property. House ID may repeat across different properties.
-      To uniquely identify a house, use the combination of property_id and house_id.
-    - date (TEXT): Date of purchase (format YYYY-MM-DD).
-    - city (TEXT): City in Connecticut where the house is located.
-    - agent_id (INTEGER): Identifier of the agent (values range across multiple agents; not sequential).
-    - expected_sale_price (REAL): Expected price of the house, typically between 300,000 and 1,000,000.
-    - actual_sale_price (REAL): Actual sold price, similar range as expected_sale_price.
-    - number_of_days_on_listing (INTEGER): Days the house was listed before being sold.
-    - number_of_beds (INTEGER): Number of bedrooms (2, 3, or 4).
-    - number_of_baths (INTEGER): Number of bathrooms (2, 3, or 4).
-
-    Your job is to:
-    - Return a valid SQLite SQL query using this schema.
-    - If the question includes phrases like "top N", "most", "least", "frequent", or "popular", use appropriate aggregation (e.g., COUNT) and sorting (e.g., ORDER BY COUNT DESC).
-    - When calculating metrics like profit or prices across multiple houses, use `AVG()` or `SUM()` with aggregation
-    - Always use aliases (e.g., AS house_count or AS most_common_city) for aggregated columns.
-    - Do NOT include explanations, markdown, or comments. Only return the SQL query.
-    """
-
+@traceable(name="generate_sql_query", process_inputs=redact_inputs("user_question"))
+async def generate_sql_query(user_question, previous_query=None, error_msg=None, temperature=0):
     if error_msg and previous_query:
         logger.warning("[SQL] Previous query failed. Regenerating with error context.")
         user_question = (
@@ -56,52 +62,50 @@ def generate_sql_query(user_question, previous_query=None, error_msg=None):
             f"Please fix and return a valid query using proper column aliases."
         )
 
-    logger.info(f"[SQL] Generating SQL for: {user_question}")
+    # The question may carry injected chat memory, so it only appears at DEBUG
+    logger.debug("[SQL] Generating SQL for: %s", user_question)
     messages = [
-        {"role": "system", "content": schema},
+        {"role": "system", "content": SQL_SYSTEM_PROMPT},
         {"role": "user", "content": user_question}
     ]
 
     try:
-        response = client.chat.completions.create(
+        response = await chat_completion(
+            client,
             model="gpt-4",
             messages=messages,
-            temperature=0
+            temperature=temperature
         )
         return response.choices[0].message.content.strip()
     except Exception as e:
         logger.exception(f"[SQL] Failed to generate SQL from GPT: {e}")
         return ""
 
+# Follow-ups refer back with pronouns or connectives, or are too short to stand alone
+_CONTEXT_RE = re.compile(r"\b(it|that|they|them|those|same|previous|above|earlier|also|and|instead)\b", re.I)
+
 # Determine if chat context is needed
-@traceable(name="needs_chat_context")
-def needs_chat_context(question, chat_memory_dict=None):
+@traceable(name="needs_chat_context", process_inputs=redact_inputs("chat_memory_dict"))
+async def needs_chat_context(question, chat_memory_dict=None, history=None, use_llm_context_check=False):
     if not chat_memory_dict:
         return False 
 
-    chat_pairs = "\n".join([
-        f"User: {chat_memory_dict[f'q{i}']}\nAssistant: {chat_memory_dict[f'a{i}']}"
-        for i in range(1, len(chat_memory_dict) // 2 + 1)
-    ])
-
-    prompt = f"""
-    You are an assistant that decides whether a user's current question depends on earlier conversation context.
-
-    Prior Chat:
-    {chat_pairs if chat_pairs else '[No prior chat]'}
-
-    Current Question:
-    {question}
+    # The local heuristic is the default; the LLM check is kept for comparison
+    if not use_llm_context_check:
+        return bool(_CONTEXT_RE.search(question)) or len(question.split()) < 6
 
-    Answer with only one word: "yes" if it needs previous context, otherwise "no".
-    """
+    chat_pairs = history if history is not None else render_history(chat_memory_dict)
+    prompt = f"Prior Chat:\n{chat_pairs or '[No prior chat]'}\n\nCurrent Question:\n{question}"
 
     try:
         logger.info("[SQL] Determining if chat context is needed...")
-        response = client.chat.completions.create(
-            model="gpt-4",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0
+        # "yes" and "no" are single tokens, so one output token is enough
+        response = await chat_completion(
+            client,
+            model=MODEL_CLASSIFY,
+            messages=[{"role": "system", "content": CONTEXT_CHECK_PROMPT}, {"role": "user", "content": prompt}],
+            temperature=0,
+            max_tokens=1
         )
         result = response.choices[0].message.content.strip().lower()
         return result == "yes"
@@ -109,22 +113,68 @@ def needs_chat_context(question, chat_memory_dict=None):
         logger.warning(f"[SQL] Context check failed: {e}")
         return False
 
-# Traced SQL query handler with contextual memory
-@traceable(name="handle_user_question")
-def handle_user_question(user_question, conn, property_mention=None, agent_mention=None, chat_memory_dict=None, max_retries=3):
-    attempt = 0
-    error_msg = None
-    sql_query = None
+# Reply for small talk, and when GPT answers with prose instead of SQL
+HELP_MESSAGE = (
+    "I can help you analyze your property data. "
+    "I have access to sales data (CSV), customer and agent feedback (JSON), and property descriptions (PDFs). "
+    "Let me know what insights you're looking for."
+)
 
+# Traced SQL query handler with contextual memory
+@traceable(name="handle_user_question", process_inputs=redact_inputs("chat_memory_dict"), process_outputs=redact_outputs)
+async def handle_user_question(user_question, conn, property_mention=None, agent_mention=None, chat_memory_dict=None, max_retries=3):
+    # Small talk is answered before any SQL generation. Only a confident "general" label counts,
+    # so data questions outside the prototypes still reach GPT; routing already embedded the question
+    if not (property_mention or agent_mention) and not await needs_chat_context(user_question, chat_memory_dict):
+        if await asyncio.to_thread(general_classifier.classify, user_question) == "general":
+            logger.info("[SQL] Small talk, returning help message.")
+            return HELP_MESSAGE
+
+    # Same key as the feedback cache: only the same question, mentions, previous turn and data
+    # version reuse rows, since "most" vs "least" or one city vs another embed almost identically
+    key = (
+        question_key(user_question), str(property_mention), str(agent_mention),
+        last_turn_hash(chat_memory_dict), get_sqlite_data_version()
+    )
+    return await response_cache.aget_or_compute(
+        key,
+        lambda: _answer_sql_question(user_question, conn, property_mention, agent_mention, chat_memory_dict, max_retries),
+        cache_if=lambda result: isinstance(result, list)
+    )
+
+# Candidate temperatures raced on the first attempt; the first one that returns rows wins
+CANDIDATE_TEMPERATURES = (0, 0.3)
+
+def _is_sql(sql_query):
+    return sql_query.strip().lower().startswith(("select", "with"))
+
+# Returns (records or None, error text or None)
+# Rows go straight to records; building a DataFrame first only to convert it back costs more than the query
+def _execute(sql_query, conn):
+    try:
+        cursor = conn.execute(sql_query)
+        rows = cursor.fetchall()
+    except Exception:
+        return None, traceback.format_exc()
+    if not rows or cursor.description is None:
+        return None, None
+    columns = [d[0] for d in cursor.description]
+    return [dict(zip(columns, row)) for row in rows], None
+
+async def _try_candidate(user_question, conn, temperature):
+    sql_query = await generate_sql_query(user_question, temperature=temperature)
+    if not sql_query or not _is_sql(sql_query):
+        return sql_query, None, None
+    records, error_msg = await asyncio.to_thread(_execute, sql_query, conn)
+    return sql_query, records, error_msg
+
+async def _answer_sql_question(user_question, conn, property_mention, agent_mention, chat_memory_dict, max_retries):
     logger.info(f"[SQL] Handling user question: {user_question}")
 
-    if needs_chat_context(user_question, chat_memory_dict):
+    # Rendered once for both the context check and the prompt
+    memory_text = render_history(chat_memory_dict)
+    if await needs_chat_context(user_question, chat_memory_dict, history=memory_text):
         logger.info("[SQL] Injecting chat memory into question...")
-        memory_blocks = [
-            f"User: {chat_memory_dict[f'q{i}']}\nAssistant: {chat_memory_dict[f'a{i}']}"
-            for i in range(1, len(chat_memory_dict) // 2 + 1)
-        ]
-        memory_text = "\n".join(memory_blocks)
         user_question = f"Conversation so far:\n{memory_text}\n\nNow answer this: {user_question}"
 
     if property_mention:
@@ -132,8 +182,36 @@ def handle_user_question(user_question, conn, property_mention=None, agent_menti
     if agent_mention:
         user_question = f"The user is referring to {agent_mention}. " + user_question
 
-    while attempt < max_retries:
-        sql_query = generate_sql_query(user_question, sql_query, error_msg)
+    # First attempt: race candidates generated at different temperatures, keep the first with rows
+    candidates = [asyncio.create_task(_try_candidate(user_question, conn, t)) for t in CANDIDATE_TEMPERATURES]
+    outcomes = []
+    try:
+        for next_done in asyncio.as_completed(candidates):
+            sql_query, records, error_msg = await next_done
+            logger.info(f"[SQL] Candidate query:\n{sql_query}")
+            if records:
+                logger.info(f"[SQL] Query successful. Rows returned: {len(records)}")
+                return records
+            outcomes.append((sql_query, error_msg))
+    finally:
+        for task in candidates:
+            task.cancel()
+
+    if not any(sql_query for sql_query, _ in outcomes):
+        logger.error("[SQL] No SQL query was generated.")
+        return "Failed to generate SQL."
+    if not any(sql_query and _is_sql(sql_query) for sql_query, _ in outcomes):
+        logger.warning("[SQL] Detected non-SQL response from GPT.")
+        return HELP_MESSAGE
+    if any(sql_query and _is_sql(sql_query) and not error_msg for sql_query, error_msg in outcomes):
+        logger.warning("[SQL] Query executed but returned no rows.")
+        return None
+
+    # Every candidate failed to run: fall back to sequential repair from the last error
+    sql_query, error_msg = next((q, e) for q, e in reversed(outcomes) if e)
+    logger.warning(f"[SQL] Candidates failed: {error_msg.splitlines()[-1]}")
+    for attempt in range(1, max_retries):
+        sql_query = await generate_sql_query(user_question, sql_query, error_msg)
         if not sql_query:
             logger.error("[SQL] No SQL query was generated.")
             return "Failed to generate SQL."
@@ -141,26 +219,18 @@ def handle_user_question(user_question, conn, property_mention=None, agent_menti
         logger.info(f"[SQL] Attempt {attempt+1}: Generated query:\n{sql_query}")
 
         # Check for non-SQL responses like explanations or apologies
-        if not sql_query.strip().lower().startswith(("select", "with")):
+        if not _is_sql(sql_query):
             logger.warning("[SQL] Detected non-SQL response from GPT.")
-            return (
-                "I can help you analyze your property data. "
-                "I have access to sales data (CSV), customer and agent feedback (JSON), and property descriptions (PDFs). "
-                "Let me know what insights you're looking for."
-            )
-
-        try:
-            result_df = pd.read_sql_query(sql_query, conn)
-            if not result_df.empty:
-                logger.info(f"[SQL] Query successful. Rows returned: {len(result_df)}")
-                return result_df.to_dict(orient='records')
-            else:
-                logger.warning("[SQL] Query executed but returned no rows.")
-                return None
-        except Exception:
-            error_msg = traceback.format_exc()
-            logger.warning(f"[SQL] Query failed on attempt {attempt+1}: {error_msg.splitlines()[-1]}")
-            attempt += 1
+            return HELP_MESSAGE
+
+        records, error_msg = await asyncio.to_thread(_execute, sql_query, conn)
+        if records:
+            logger.info(f"[SQL] Query successful. Rows returned: {len(records)}")
+            return records
+        if not error_msg:
+            logger.warning("[SQL] Query executed but returned no rows.")
+            return None
+        logger.warning(f"[SQL] Query failed on attempt {attempt+1}: {error_msg.splitlines()[-1]}")
 
     logger.error("[SQL] Query failed after maximum retries.")
     return None